@@ -4,7 +4,521 @@ Note that solved configuration has the blank (zero) tile in upper left
 Use the arrows key to swap this tile with its neighbors
 """
 
-import poc_fifteen_gui
+import os
+import sys
+import copy
+import json
+import mmap
+import time
+import Queue
+import random
+import argparse
+import threading
+import multiprocessing
+from array import array
+
+# The GUI only exists in CodeSkulptor; the batch command line runs without it
+try:
+    import poc_fifteen_gui
+except ImportError:
+    poc_fifteen_gui = None
+
+# Moves of the zero tile used by the optimal solver: (direction, row offset, col offset)
+ZERO_MOVES = (("l", 0, -1), ("r", 0, 1), ("u", -1, 0), ("d", 1, 0))
+OPPOSITE = {"l": "r", "r": "l", "u": "d", "d": "u"}
+FOUND = -1
+
+# Disjoint 6-6-3 partition of the tiles for the 4x4 additive pattern databases
+PARTITION_4X4 = ((1, 5, 6, 9, 10, 13), (7, 8, 11, 12, 14, 15), (2, 3, 4))
+# Marks pattern placements that were never reached in a pattern database
+PDB_UNSEEN = 255
+
+# Debug mode: check every invariant against a full scan of the board
+VERIFY_INVARIANTS = False
+
+MASK64 = (1 << 64) - 1
+# Most moves simplify_moves remembers at once, each costs roughly 200 bytes
+SIMPLIFY_WINDOW = 100000
+
+# Widest top 2xN region solved by an optimal move table, and the table codes
+ENDGAME_WIDTH = 4
+ENDGAME_MOVES = "lrud"
+ENDGAME_SOLVED = 4
+ENDGAME_UNSEEN = 255
+# Move tables already read from disk, by region width, and the solutions
+# walked from them, by region width and permutation rank
+ENDGAME_TABLES = {}
+ENDGAME_SOLUTIONS = {}
+
+
+def line_conflicts(goals):
+    """
+    Linear conflict penalty for a single row or column
+    goals lists the goal offsets (in the line) of the tiles that belong
+    to this line, in the order in which they currently appear
+    Returns an integer
+    """
+    goals = list(goals)
+    penalty = 0
+    while len(goals) > 1:
+        conflicts = [0] * len(goals)
+        for idx in range(len(goals)):
+            for jdx in range(idx + 1, len(goals)):
+                if goals[idx] > goals[jdx]:
+                    conflicts[idx] += 1
+                    conflicts[jdx] += 1
+        worst = max(conflicts)
+        if worst == 0:
+            break
+        # Every tile removed from the line costs two extra moves
+        goals.pop(conflicts.index(worst))
+        penalty += 2
+    return penalty
+
+
+class ManhattanHeuristic:
+    """
+    Manhattan distance plus linear conflict heuristic for the optimal solver
+    Works on a flat board where the number of a tile is its solved index
+    """
+
+    def __init__(self, linear_conflict=True):
+        """
+        Create the heuristic, linear conflicts can be switched off
+        """
+        self._linear_conflict = linear_conflict
+        self._board = []
+        self._height = 0
+        self._width = 0
+        self._distance = 0
+        self._row_conflicts = []
+        self._col_conflicts = []
+
+    def reset(self, board, height, width):
+        """
+        Start tracking the given flat board
+        Returns the heuristic value of the board
+        """
+        self._board = board
+        self._height = height
+        self._width = width
+        self._distance = 0
+        for pos in range(height * width):
+            if board[pos] != 0:
+                self._distance += self.tile_distance(board[pos], pos)
+        self._row_conflicts = [0] * height
+        self._col_conflicts = [0] * width
+        if self._linear_conflict:
+            for row in range(height):
+                self._row_conflicts[row] = self.row_conflicts(row)
+            for col in range(width):
+                self._col_conflicts[col] = self.col_conflicts(col)
+        return self.value()
+
+    def value(self):
+        """
+        Current heuristic value
+        Returns an integer
+        """
+        return self._distance + sum(self._row_conflicts) + sum(self._col_conflicts)
+
+    def tile_distance(self, tile, pos):
+        """
+        Manhattan distance of tile at flat position pos from its solved position
+        Returns an integer
+        """
+        row, col = divmod(pos, self._width)
+        goal_row, goal_col = divmod(tile, self._width)
+        return abs(row - goal_row) + abs(col - goal_col)
+
+    def row_conflicts(self, row):
+        """
+        Linear conflict penalty of the given row
+        Returns an integer
+        """
+        start = row * self._width
+        goals = [self._board[pos] % self._width
+                 for pos in range(start, start + self._width)
+                 if self._board[pos] != 0 and self._board[pos] / self._width == row]
+        return line_conflicts(goals)
+
+    def col_conflicts(self, col):
+        """
+        Linear conflict penalty of the given column
+        Returns an integer
+        """
+        goals = [self._board[pos] / self._width
+                 for pos in range(col, self._height * self._width, self._width)
+                 if self._board[pos] != 0 and self._board[pos] % self._width == col]
+        return line_conflicts(goals)
+
+    def apply(self, tile, src, dst):
+        """
+        Update the heuristic after tile was moved from flat position src
+        to dst (the board has already been updated)
+        Returns the new heuristic value
+        """
+        self._distance += self.tile_distance(tile, dst) - self.tile_distance(tile, src)
+        if self._linear_conflict:
+            # A tile only changes its order relative to other tiles
+            # in the two lines it leaves and enters
+            src_row, src_col = divmod(src, self._width)
+            dst_row, dst_col = divmod(dst, self._width)
+            if src_row != dst_row:
+                self._row_conflicts[src_row] = self.row_conflicts(src_row)
+                self._row_conflicts[dst_row] = self.row_conflicts(dst_row)
+            else:
+                self._col_conflicts[src_col] = self.col_conflicts(src_col)
+                self._col_conflicts[dst_col] = self.col_conflicts(dst_col)
+        return self.value()
+
+
+def ida_star(board, height, width, heuristic):
+    """
+    Iterative deepening A* search on a flat board
+    heuristic must be admissible and zero only on the solved board
+    Returns a tuple of the optimal move string and the number of nodes expanded
+    """
+    board = list(board)
+    path = []
+    nodes = [0]
+
+    def search(zero_pos, cost, bound, last, estimate):
+        """
+        Depth first search bounded by cost + estimate <= bound
+        Returns FOUND or the smallest bound exceeding the current one
+        """
+        if cost + estimate > bound:
+            return cost + estimate
+        if estimate == 0:
+            return FOUND
+        nodes[0] += 1
+        minimum = float("inf")
+        zero_row, zero_col = divmod(zero_pos, width)
+        for direction, d_row, d_col in ZERO_MOVES:
+            row = zero_row + d_row
+            col = zero_col + d_col
+            if direction == OPPOSITE.get(last) or not (0 <= row < height and 0 <= col < width):
+                continue
+            pos = row * width + col
+            tile = board[pos]
+            board[zero_pos] = tile
+            board[pos] = 0
+            path.append(direction)
+            result = search(pos, cost + 1, bound,
+                            direction, heuristic.apply(tile, pos, zero_pos))
+            if result == FOUND:
+                return FOUND
+            path.pop()
+            board[pos] = tile
+            board[zero_pos] = 0
+            heuristic.apply(tile, zero_pos, pos)
+            minimum = min(minimum, result)
+        return minimum
+
+    bound = heuristic.reset(board, height, width)
+    zero_pos = board.index(0)
+    while True:
+        result = search(zero_pos, 0, bound, None, heuristic.value())
+        if result == FOUND:
+            return "".join(path), nodes[0]
+        bound = result
+
+
+def write_table(path, table):
+    """
+    Write a table file atomically: it is written under a temporary name
+    and renamed into place, so processes mapping or reading path never
+    see a truncated or half written table
+    """
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary_path, "wb") as table_file:
+        table_file.write(table)
+    os.rename(temporary_path, path)
+
+
+def build_pattern_database(height, width, pattern, path):
+    """
+    Build the additive pattern database for the given pattern tiles by
+    backward breadth first search from the solved board, where only moves
+    of pattern tiles count, and write it to path with one byte per entry
+    The entry for a placement is at index sum(pos_i * cells ** i), so a
+    k tile pattern takes cells ** k bytes on disk plus cells ** (k + 1)
+    bits while building: 16 MB and 32 MB for 6 tiles on 4x4, 9.3 MB and
+    29 MB for 5 tiles on 5x5, but about 1 GB for 6 tiles on 5x5
+    """
+    cells = height * width
+    num_tiles = len(pattern)
+    weights = [cells ** idx for idx in range(num_tiles)]
+    table = bytearray([PDB_UNSEEN]) * (cells ** num_tiles)
+    # One bit per (placement, zero position) state
+    visited = bytearray((cells ** (num_tiles + 1) + 7) / 8)
+
+    start = sum(tile * weight for tile, weight in zip(pattern, weights))
+    frontier = array("l", [start * cells])
+    cost = 0
+    while len(frontier) > 0:
+        next_frontier = array("l")
+        # Moves of other tiles are free, so expand them within this level
+        while len(frontier) > 0:
+            state = frontier.pop()
+            if visited[state >> 3] & (1 << (state & 7)):
+                continue
+            visited[state >> 3] |= 1 << (state & 7)
+            index, zero_pos = divmod(state, cells)
+            if table[index] == PDB_UNSEEN:
+                table[index] = min(cost, PDB_UNSEEN - 1)
+            positions = []
+            rest = index
+            for dummy_tile in range(num_tiles):
+                rest, pos = divmod(rest, cells)
+                positions.append(pos)
+            zero_row, zero_col = divmod(zero_pos, width)
+            for dummy_dir, d_row, d_col in ZERO_MOVES:
+                row = zero_row + d_row
+                col = zero_col + d_col
+                if not (0 <= row < height and 0 <= col < width):
+                    continue
+                pos = row * width + col
+                if pos in positions:
+                    weight = weights[positions.index(pos)]
+                    neighbor = (index + (zero_pos - pos) * weight) * cells + pos
+                    if not visited[neighbor >> 3] & (1 << (neighbor & 7)):
+                        next_frontier.append(neighbor)
+                else:
+                    neighbor = index * cells + pos
+                    if not visited[neighbor >> 3] & (1 << (neighbor & 7)):
+                        frontier.append(neighbor)
+        frontier = next_frontier
+        cost += 1
+
+    write_table(path, table)
+
+
+class PatternDatabase:
+    """
+    Pattern database table shared between processes through mmap
+    """
+
+    def __init__(self, height, width, pattern, path):
+        """
+        Map the table for the given pattern tiles stored at path
+        """
+        self._pattern = tuple(pattern)
+        self._cells = height * width
+        self._weights = [self._cells ** idx for idx in range(len(pattern))]
+        table_file = open(path, "rb")
+        self._table = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        table_file.close()
+        assert len(self._table) == self._cells ** len(pattern), "bad table size: " + path
+
+    def get_pattern(self):
+        """
+        Getter for the pattern tiles
+        Returns a tuple of integers
+        """
+        return self._pattern
+
+    def get_weight(self, tile):
+        """
+        Weight of the given pattern tile in the table index
+        Returns an integer
+        """
+        return self._weights[self._pattern.index(tile)]
+
+    def index(self, board):
+        """
+        Table index for the placement of the pattern tiles on a flat board
+        Returns an integer
+        """
+        return sum(board.index(tile) * weight
+                   for tile, weight in zip(self._pattern, self._weights))
+
+    def lookup(self, index):
+        """
+        Number of pattern tile moves needed for the given placement
+        Returns an integer
+        """
+        return ord(self._table[index])
+
+    def close(self):
+        """
+        Unmap the table
+        """
+        self._table.close()
+
+
+def pattern_database_path(directory, height, width, pattern):
+    """
+    File name used to cache the table for the given pattern
+    Returns a string
+    """
+    name = "pdb_%dx%d_%s.bin" % (height, width, "-".join(str(tile) for tile in pattern))
+    return os.path.join(directory, name)
+
+
+def load_pattern_databases(height, width, partition, directory="."):
+    """
+    Load the pattern databases of a disjoint partition of the tiles,
+    building and caching any missing table in directory first
+    Returns a list of PatternDatabase objects
+    """
+    databases = []
+    for pattern in partition:
+        path = pattern_database_path(directory, height, width, pattern)
+        if not os.path.exists(path):
+            build_pattern_database(height, width, pattern, path)
+        databases.append(PatternDatabase(height, width, pattern, path))
+    return databases
+
+
+class PatternDatabaseHeuristic:
+    """
+    Additive pattern database heuristic for the optimal solver
+    The patterns must be disjoint; tiles in no pattern add their Manhattan
+    distance instead, which keeps the sum admissible, so a few small
+    patterns can serve as a partial database for larger puzzles
+    """
+
+    def __init__(self, databases):
+        """
+        Create the heuristic from a list of PatternDatabase objects
+        """
+        self._databases = list(databases)
+        self._owner = {}
+        for number, database in enumerate(self._databases):
+            for tile in database.get_pattern():
+                self._owner[tile] = (number, database.get_weight(tile))
+        self._indices = []
+        self._values = []
+        self._width = 0
+        self._distance = 0
+
+    def reset(self, board, height, width):
+        """
+        Start tracking the given flat board
+        Returns the heuristic value of the board
+        """
+        assert max(self._owner) < height * width, "patterns do not fit the puzzle"
+        self._width = width
+        self._indices = [database.index(board) for database in self._databases]
+        self._values = [database.lookup(index)
+                        for database, index in zip(self._databases, self._indices)]
+        self._distance = 0
+        for pos in range(height * width):
+            if board[pos] != 0 and board[pos] not in self._owner:
+                self._distance += self.tile_distance(board[pos], pos)
+        return self.value()
+
+    def value(self):
+        """
+        Current heuristic value
+        Returns an integer
+        """
+        return sum(self._values) + self._distance
+
+    def tile_distance(self, tile, pos):
+        """
+        Manhattan distance of tile at flat position pos from its solved position
+        Returns an integer
+        """
+        row, col = divmod(pos, self._width)
+        goal_row, goal_col = divmod(tile, self._width)
+        return abs(row - goal_row) + abs(col - goal_col)
+
+    def apply(self, tile, src, dst):
+        """
+        Update the heuristic after tile was moved from flat position src
+        to dst, only the table owning the tile needs a new lookup
+        Returns the new heuristic value
+        """
+        if tile not in self._owner:
+            self._distance += self.tile_distance(tile, dst) - self.tile_distance(tile, src)
+            return self.value()
+        number, weight = self._owner[tile]
+        self._indices[number] += (dst - src) * weight
+        self._values[number] = self._databases[number].lookup(self._indices[number])
+        return self.value()
+
+
+def zobrist_key(tile, pos, cells):
+    """
+    Pseudo random 64 bit key for a tile at a flat position (splitmix64),
+    the hash of a board is the xor of the keys of all its tiles
+    Returns an integer
+    """
+    value = (tile * cells + pos + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+def permutation_rank(perm):
+    """
+    Lexicographic rank (Lehmer code) of a permutation of range(len(perm))
+    Returns an integer
+    """
+    rank = 0
+    size = len(perm)
+    for idx in range(size):
+        smaller = 0
+        for jdx in range(idx + 1, size):
+            if perm[jdx] < perm[idx]:
+                smaller += 1
+        rank = rank * (size - idx) + smaller
+    return rank
+
+
+def build_endgame_table(width, path):
+    """
+    Build the optimal move table of a 2 x width puzzle by breadth first
+    search from the solved board and write it to path, one byte per
+    permutation rank holding the code of the next move towards the solution
+    """
+    cells = 2 * width
+    size = 1
+    for number in range(2, cells + 1):
+        size *= number
+    table = bytearray([ENDGAME_UNSEEN]) * size
+    solved = tuple(range(cells))
+    table[permutation_rank(solved)] = ENDGAME_SOLVED
+    queue = [solved]
+    head = 0
+    while head < len(queue):
+        state = queue[head]
+        head += 1
+        zero_row, zero_col = divmod(state.index(0), width)
+        for direction, d_row, d_col in ZERO_MOVES:
+            row = zero_row + d_row
+            col = zero_col + d_col
+            if not (0 <= row < 2 and 0 <= col < width):
+                continue
+            neighbor = list(state)
+            neighbor[zero_row * width + zero_col] = state[row * width + col]
+            neighbor[row * width + col] = 0
+            rank = permutation_rank(neighbor)
+            if table[rank] == ENDGAME_UNSEEN:
+                # From the neighbor, undoing this move leads to the solution
+                table[rank] = ENDGAME_MOVES.index(OPPOSITE[direction])
+                queue.append(tuple(neighbor))
+
+    write_table(path, table)
+
+
+def load_endgame_table(width, directory="."):
+    """
+    Load the move table of the 2 x width region, building and caching it
+    in directory the first time
+    Returns a bytearray
+    """
+    if width not in ENDGAME_TABLES:
+        path = os.path.join(directory, "endgame_2x%d.bin" % width)
+        if not os.path.exists(path):
+            build_endgame_table(width, path)
+        with open(path, "rb") as table_file:
+            ENDGAME_TABLES[width] = bytearray(table_file.read())
+    return ENDGAME_TABLES[width]
+
 
 class Puzzle:
     """
@@ -18,14 +532,20 @@ class Puzzle:
         """
         self._height = puzzle_height
         self._width = puzzle_width
-        self._grid = [[col + puzzle_width * row
-                       for col in range(self._width)]
-                      for row in range(self._height)]
+        # Flat row-major board plus the inverse index of tile positions
+        self._tiles = array("l", range(puzzle_height * puzzle_width))
 
         if initial_grid != None:
             for row in range(puzzle_height):
                 for col in range(puzzle_width):
-                    self._grid[row][col] = initial_grid[row][col]
+                    self._tiles[col + puzzle_width * row] = initial_grid[row][col]
+
+        self._positions = array("l", [0]) * len(self._tiles)
+        for pos in range(len(self._tiles)):
+            self._positions[self._tiles[pos]] = pos
+
+        self.reset_frontiers()
+        self._solver_stats = {}
 
     def __str__(self):
         """
@@ -34,7 +554,7 @@ class Puzzle:
         """
         ans = ""
         for row in range(self._height):
-            ans += str(self._grid[row])
+            ans += str(list(self._tiles[row * self._width:(row + 1) * self._width]))
             ans += "\n"
         return ans
 
@@ -60,20 +580,27 @@ class Puzzle:
         Getter for the number at tile position pos
         Returns an integer
         """
-        return self._grid[row][col]
+        return self._tiles[col + self._width * row]
 
     def set_number(self, row, col, value):
         """
         Setter for the number at tile position pos
         """
-        self._grid[row][col] = value
+        self._tiles[col + self._width * row] = value
+        self._positions[value] = col + self._width * row
+        self.reset_frontiers()
 
     def clone(self):
         """
         Make a copy of the puzzle to update during solving
         Returns a Puzzle object
         """
-        new_puzzle = Puzzle(self._height, self._width, self._grid)
+        # copy.copy skips __init__, which would rebuild the position index
+        new_puzzle = copy.copy(self)
+        new_puzzle._tiles = self._tiles[:]
+        new_puzzle._positions = self._positions[:]
+        new_puzzle._solver_stats = {}
+        new_puzzle.reset_frontiers()
         return new_puzzle
 
     ########################################################
@@ -86,41 +613,99 @@ class Puzzle:
         Returns a tuple of two integers        
         """
         solved_value = (solved_col + self._width * solved_row)
-
-        for row in range(self._height):
-            for col in range(self._width):
-                if self._grid[row][col] == solved_value:
-                    return (row, col)
-        assert False, "Value " + str(solved_value) + " not found"
+        return divmod(self._positions[solved_value], self._width)
 
     def update_puzzle(self, move_string):
         """
         Updates the puzzle state based on the provided move string
         """
-        zero_row, zero_col = self.current_position(0, 0)
+        width = self._width
+        tiles = self._tiles
+        positions = self._positions
+        zero_pos = positions[0]
+        frontier = self._frontier
+        misplaced = self._misplaced
+        row0_frontier = self._row0_frontier
+        row0_misplaced = self._row0_misplaced
         for direction in move_string:
             if direction == "l":
-                assert zero_col > 0, "move off grid: " + direction
-                self._grid[zero_row][zero_col] = self._grid[zero_row][zero_col - 1]
-                self._grid[zero_row][zero_col - 1] = 0
-                zero_col -= 1
+                assert zero_pos % width > 0, "move off grid: " + direction
+                pos = zero_pos - 1
             elif direction == "r":
-                assert zero_col < self._width - 1, "move off grid: " + direction
-                self._grid[zero_row][zero_col] = self._grid[zero_row][zero_col + 1]
-                self._grid[zero_row][zero_col + 1] = 0
-                zero_col += 1
+                assert zero_pos % width < width - 1, "move off grid: " + direction
+                pos = zero_pos + 1
             elif direction == "u":
-                assert zero_row > 0, "move off grid: " + direction
-                self._grid[zero_row][zero_col] = self._grid[zero_row - 1][zero_col]
-                self._grid[zero_row - 1][zero_col] = 0
-                zero_row -= 1
+                assert zero_pos >= width, "move off grid: " + direction
+                pos = zero_pos - width
             elif direction == "d":
-                assert zero_row < self._height - 1, "move off grid: " + direction
-                self._grid[zero_row][zero_col] = self._grid[zero_row + 1][zero_col]
-                self._grid[zero_row + 1][zero_col] = 0
-                zero_row += 1
+                assert zero_pos < len(tiles) - width, "move off grid: " + direction
+                pos = zero_pos + width
             else:
                 assert False, "invalid direction: " + direction
+            tile = tiles[pos]
+            tiles[zero_pos] = tile
+            tiles[pos] = 0
+            positions[tile] = zero_pos
+            # Only the moved tile can enter or leave its solved position
+            if tile >= frontier:
+                if pos == tile:
+                    misplaced += 1
+                elif zero_pos == tile:
+                    misplaced -= 1
+            if row0_frontier <= tile < width:
+                if pos == tile:
+                    row0_misplaced += 1
+                elif zero_pos == tile:
+                    row0_misplaced -= 1
+            zero_pos = pos
+        positions[0] = zero_pos
+        self._misplaced = misplaced
+        self._row0_misplaced = row0_misplaced
+
+    def reset_frontiers(self):
+        """
+        Stop tracking solved tiles, the frontiers are rebuilt lazily
+        by the next invariant checks
+        """
+        self._frontier = len(self._tiles)
+        self._misplaced = 0
+        self._row0_frontier = self._width
+        self._row0_misplaced = 0
+
+    def solved_from(self, number):
+        """
+        Check whether every tile numbered number or more is in place
+        Moves the tracked frontier to number, which is amortized O(1)
+        as the solver moves it steadily towards the zero tile
+        Returns a boolean
+        """
+        positions = self._positions
+        while self._frontier > number:
+            self._frontier -= 1
+            if positions[self._frontier] != self._frontier:
+                self._misplaced += 1
+        while self._frontier < number:
+            if positions[self._frontier] != self._frontier:
+                self._misplaced -= 1
+            self._frontier += 1
+        return self._misplaced == 0
+
+    def row0_solved_from(self, target_col):
+        """
+        Check whether the tiles of row zero from target_col on are in place
+        Moves the tracked row zero frontier to target_col
+        Returns a boolean
+        """
+        positions = self._positions
+        while self._row0_frontier > target_col:
+            self._row0_frontier -= 1
+            if positions[self._row0_frontier] != self._row0_frontier:
+                self._row0_misplaced += 1
+        while self._row0_frontier < target_col:
+            if positions[self._row0_frontier] != self._row0_frontier:
+                self._row0_misplaced -= 1
+            self._row0_frontier += 1
+        return self._row0_misplaced == 0
 
     ##################################################################
     # Phase one methods
@@ -131,7 +716,17 @@ class Puzzle:
         at the given position in the bottom rows of the puzzle (target_row > 1)
         Returns a boolean
         """
-        # replace with your code
+        number = target_row * self._width + target_col
+        result = self._positions[0] == number and self.solved_from(number + 1)
+        if VERIFY_INVARIANTS:
+            assert result == self.lower_row_invariant_scan(target_row, target_col)
+        return result
+
+    def lower_row_invariant_scan(self, target_row, target_col):
+        """
+        Full scan version of lower_row_invariant for debugging
+        Returns a boolean
+        """
         result = True
         if self.get_number(target_row, target_col) != 0:
             result = False
@@ -202,18 +797,9 @@ class Puzzle:
         Place correct tile at target position
         Updates puzzle and returns a move string
         """ 
-        width = self.get_width()
-        height = self.get_height()
         move_string = ""
 
-        cur_row = 0
-        cur_col = 0
-        for row in range(height):
-            for col in range(width):
-                if self.get_number(row, col) == target_row * width + target_col:
-                    cur_row = row
-                    cur_col = col
-                    break
+        cur_row, cur_col = self.current_position(target_row, target_col)
         
         target_pos = (target_row, target_col)
         target_tile = (cur_row, cur_col)
@@ -228,31 +814,23 @@ class Puzzle:
         Updates puzzle and returns a move string
         """
         assert self.lower_row_invariant(target_row, 0)
-        # Move 0 tile to (i - 1, 1)
+        # Move 0 tile to (i - 1, 1), applied in place instead of on a clone
         move_string = "ur"
-        new_puzzle = self.clone()
-        new_puzzle.update_puzzle(move_string)
+        self.update_puzzle(move_string)
         # Find the target tile
         width = self.get_width()
-        height = self.get_height()
-        target_number = target_row * width
-        for row in range(height):
-            for col in range(width):
-                if new_puzzle.get_number(row, col) == target_number:
-                    cur_row = row
-                    cur_col = col
-                    break
+        cur_row, cur_col = self.current_position(target_row, 0)
                     
         if cur_row == target_row and cur_col == 0:
-            move_string += "r" * (width - 2)
-            self.update_puzzle(move_string)
+            rest_string = "r" * (width - 2)
         else:
             target_pos = (target_row - 1, 1)
             target_tile = (cur_row, cur_col)
-            move_string = self.position_tile(target_pos, target_tile, move_string)
-            move_string += "ruldrdlurdluurddlur" # From homework 9
-            move_string += "r" * (width - 2)
-            self.update_puzzle(move_string)
+            rest_string = self.position_tile(target_pos, target_tile, "")
+            rest_string += "ruldrdlurdluurddlur" # From homework 9
+            rest_string += "r" * (width - 2)
+        self.update_puzzle(rest_string)
+        move_string += rest_string
             
         assert self.lower_row_invariant(target_row - 1, width - 1)
         return move_string
@@ -266,6 +844,18 @@ class Puzzle:
         at the given column (col > 1)
         Returns a boolean
         """
+        result = (self._positions[0] == target_col
+                  and self.row0_solved_from(target_col + 1)
+                  and self.solved_from(self._width + target_col))
+        if VERIFY_INVARIANTS:
+            assert result == self.row0_invariant_scan(target_col)
+        return result
+
+    def row0_invariant_scan(self, target_col):
+        """
+        Full scan version of row0_invariant for debugging
+        Returns a boolean
+        """
         result = True
         width = self.get_width()
         height = self.get_height()
@@ -290,8 +880,19 @@ class Puzzle:
         at the given column (col > 1)
         Returns a boolean
         """
+        result = (self.lower_row_invariant(1, target_col)
+                  and self.row0_solved_from(target_col + 1))
+        if VERIFY_INVARIANTS:
+            assert result == self.row1_invariant_scan(target_col)
+        return result
+
+    def row1_invariant_scan(self, target_col):
+        """
+        Full scan version of row1_invariant for debugging
+        Returns a boolean
+        """
         result = True
-        if not self.lower_row_invariant(1, target_col):
+        if not self.lower_row_invariant_scan(1, target_col):
             result = False
         width = self.get_width()
         for col in range(target_col + 1, width):
@@ -305,29 +906,20 @@ class Puzzle:
         Updates puzzle and returns a move string
         """
         assert self.row0_invariant(target_col)
+        # Applied in place instead of on a clone
         move_string = "ld"
-        new_puzzle = self.clone()
-        new_puzzle.update_puzzle(move_string)
-        target_num = target_col
-        width = self.get_width()
-        height = self.get_height()
-        for row in range(height):
-            for col in range(width):
-                if new_puzzle.get_number(row, col) == target_num:
-                    cur_row = row
-                    cur_col = col
-                    break
+        self.update_puzzle(move_string)
+        cur_row, cur_col = self.current_position(0, target_col)
                     
         if cur_row == 0 and cur_col == target_col:
-            self.update_puzzle(move_string)
             return move_string
         else:
             target_pos = (1, target_col - 1)
             target_tile = (cur_row, cur_col)
-            move_string = self.position_tile(target_pos, target_tile, move_string)
-            move_string += "urdlurrdluldrruld"
-            self.update_puzzle(move_string)
-            return move_string
+            rest_string = self.position_tile(target_pos, target_tile, "")
+            rest_string += "urdlurrdluldrruld"
+            self.update_puzzle(rest_string)
+            return move_string + rest_string
 
     def solve_row1_tile(self, target_col):
         """
@@ -335,16 +927,7 @@ class Puzzle:
         Updates puzzle and returns a move string
         """
         assert self.row1_invariant(target_col)
-        width = self.get_width()
-        height = self.get_height()
-        
-        target_num = width + target_col
-        for row in range(height):
-            for col in range(width):
-                if self.get_number(row, col) == target_num:
-                    cur_row = row
-                    cur_col = col
-                    break
+        cur_row, cur_col = self.current_position(1, target_col)
                     
         move_string = ""
         target_pos = (1, target_col)
@@ -384,43 +967,418 @@ class Puzzle:
         self.update_puzzle(move_string)
         return move_string
 
-    def solve_puzzle(self):
+    def solve_2xn(self, region_width, table_directory="."):
+        """
+        Solve the upper left 2 x region_width part of the puzzle by
+        walking its optimal move table
+        Updates the puzzle and returns a move string
+        """
+        assert self.row1_invariant(region_width - 1)
+        width = self.get_width()
+        # Number the region tiles as in a 2 x region_width puzzle
+        cells = [row * width + col for row in range(2) for col in range(region_width)]
+        local = dict((number, idx) for idx, number in enumerate(cells))
+        state = [local[self._tiles[pos]] for pos in cells]
+        offsets = {"l": -1, "r": 1, "u": -region_width, "d": region_width}
+
+        key = (region_width, permutation_rank(state))
+        if key not in ENDGAME_SOLUTIONS:
+            table = load_endgame_table(region_width, table_directory)
+            moves = []
+            zero_pos = state.index(0)
+            code = table[key[1]]
+            while code != ENDGAME_SOLVED:
+                assert code != ENDGAME_UNSEEN, "region is not solvable"
+                direction = ENDGAME_MOVES[code]
+                pos = zero_pos + offsets[direction]
+                state[zero_pos] = state[pos]
+                state[pos] = 0
+                zero_pos = pos
+                moves.append(direction)
+                code = table[permutation_rank(state)]
+            ENDGAME_SOLUTIONS[key] = "".join(moves)
+
+        move_string = ENDGAME_SOLUTIONS[key]
+        self.update_puzzle(move_string)
+        return move_string
+
+    def solve_puzzle(self, table_directory=None):
         """
         Generate a solution string for a puzzle
+        With a table_directory the top 2 x 4 (or narrower) region is
+        solved by the optimal move tables cached there instead of macros
         Updates the puzzle and returns a move string
         """
         if self.lower_row_invariant(0, 0):
             return ""
         
-        move_string = ""
+        # Collect the moves of each step and join them once at the end
+        moves = []
         width = self.get_width()
         height = self.get_height()
         
         # Move 0 tile to the lower right corner
         if self.get_number(height - 1, width - 1) != 0:
-            for row in range(height):
-                for col in range(width):
-                    if self.get_number(row, col) == 0:
-                        zero_row = row
-                        zero_col = col
-                        break
-            move_string += "d" * (height - 1 - zero_row)
-            move_string += "r" * (width - 1 - zero_col)
+            zero_row, zero_col = self.current_position(0, 0)
+            moves.append("d" * (height - 1 - zero_row))
+            moves.append("r" * (width - 1 - zero_col))
             
-        self.update_puzzle(move_string)
+        self.update_puzzle("".join(moves))
 
         for row in range(height - 1, 1, -1):
             for col in range(width - 1, -1, -1):
-                move_string += self.solve_col0_tile(row) if col == 0 else self.solve_interior_tile(row, col)
+                moves.append(self.solve_col0_tile(row) if col == 0 else self.solve_interior_tile(row, col))
                 
-        for col in range(width - 1, 1, -1):
-            move_string += self.solve_row1_tile(col)
-            move_string += self.solve_row0_tile(col)
+        region_width = 2 if table_directory == None else min(width, ENDGAME_WIDTH)
+        for col in range(width - 1, region_width - 1, -1):
+            moves.append(self.solve_row1_tile(col))
+            moves.append(self.solve_row0_tile(col))
                 
-        move_string += self.solve_2x2()
+        if table_directory == None:
+            moves.append(self.solve_2x2())
+        else:
+            moves.append(self.solve_2xn(region_width, table_directory))
                     
+        return "".join(moves)
+
+    ###########################################################
+    # Optimal solver methods
+
+    def is_solvable(self):
+        """
+        Check the permutation parity of the puzzle against the distance
+        of the zero tile from its solved position
+        Returns a boolean
+        """
+        flat = self._tiles
+        parity = 0
+        seen = [False] * len(flat)
+        for start in range(len(flat)):
+            length = 0
+            pos = start
+            while not seen[pos]:
+                seen[pos] = True
+                pos = flat[pos]
+                length += 1
+            if length > 0:
+                parity += length - 1
+        zero_row, zero_col = self.current_position(0, 0)
+        return parity % 2 == (zero_row + zero_col) % 2
+
+    def solve_optimal(self, heuristic=None):
+        """
+        Generate a shortest solution string using IDA*
+        Defaults to Manhattan distance plus linear conflicts
+        Updates the puzzle and returns a move string
+        """
+        assert self.is_solvable(), "puzzle is not solvable"
+        if heuristic == None:
+            heuristic = ManhattanHeuristic()
+        start = time.time()
+        move_string, nodes = ida_star(self._tiles, self._height, self._width, heuristic)
+        self._solver_stats = {"nodes": nodes,
+                              "time": time.time() - start,
+                              "length": len(move_string)}
+        self.update_puzzle(move_string)
         return move_string
 
+    def get_solver_stats(self):
+        """
+        Statistics of the last solve_optimal call (nodes expanded, wall time
+        in seconds and solution length) or solve_puzzle_simplified call
+        (wall time, original and simplified solution length)
+        Returns a dictionary
+        """
+        return dict(self._solver_stats)
+
+    ###########################################################
+    # Move string simplification
+
+    def simplify_moves(self, move_string, window=SIMPLIFY_WINDOW):
+        """
+        Shorten a move string played from the current state of the puzzle
+        by cutting every loop that returns to an earlier state, which
+        includes immediately cancelling pairs such as "ud" or "lr"
+        States are compared by an incremental Zobrist hash, and only the
+        states of the last window kept moves are remembered, so memory
+        stays bounded and loops longer than that are left in place
+        Does not update the puzzle, returns the simplified move string
+        """
+        width = self._width
+        cells = len(self._tiles)
+        tiles = self._tiles[:]
+        zero_pos = self._positions[0]
+        offsets = {"l": -1, "r": 1, "u": -width, "d": width}
+
+        state = 0
+        for pos in range(cells):
+            state ^= zobrist_key(tiles[pos], pos, cells)
+        # seen maps a state hash to the number of kept moves reaching it
+        seen = {state: 0}
+        states = [state]
+        result = []
+        for direction in move_string:
+            pos = zero_pos + offsets[direction]
+            tile = tiles[pos]
+            tiles[zero_pos] = tile
+            tiles[pos] = 0
+            state ^= (zobrist_key(tile, pos, cells) ^ zobrist_key(tile, zero_pos, cells)
+                      ^ zobrist_key(0, zero_pos, cells) ^ zobrist_key(0, pos, cells))
+            zero_pos = pos
+            if state in seen:
+                # Back in an earlier state, drop the loop in between
+                while len(states) > seen[state] + 1:
+                    del seen[states.pop()]
+                    result.pop()
+            else:
+                seen[state] = len(states)
+                states.append(state)
+                result.append(direction)
+                if len(states) > window:
+                    # Start a new window from the current state
+                    seen = {state: 0}
+                    states = [state]
+        return "".join(result)
+
+    def solve_puzzle_simplified(self):
+        """
+        Solve the puzzle with solve_puzzle and simplify the solution,
+        recording the length before and after in the solver statistics
+        The simplified moves are replayed from the start, and if a hash
+        collision made them wrong the unsimplified solution is returned
+        Updates the puzzle and returns a move string
+        """
+        start_puzzle = self.clone()
+        start = time.time()
+        move_string = self.solve_puzzle()
+        simplified = start_puzzle.simplify_moves(move_string)
+        check_puzzle = start_puzzle.clone()
+        try:
+            check_puzzle.update_puzzle(simplified)
+            verified = check_puzzle.lower_row_invariant(0, 0)
+        except AssertionError:
+            # A wrong cut can walk the zero tile off the grid
+            verified = False
+        if not verified:
+            simplified = move_string
+        self._solver_stats = {"time": time.time() - start,
+                              "original_length": len(move_string),
+                              "length": len(simplified),
+                              "verified": verified}
+        return simplified
+
+
+def scrambled_puzzle(height, width, num_moves):
+    """
+    Make a solvable puzzle by applying random moves to the solved one
+    Returns a Puzzle object
+    """
+    puzzle = Puzzle(height, width)
+    zero_row, zero_col = 0, 0
+    last = None
+    move_string = ""
+    for dummy_move in range(num_moves):
+        options = [(direction, d_row, d_col) for direction, d_row, d_col in ZERO_MOVES
+                   if direction != OPPOSITE.get(last)
+                   and 0 <= zero_row + d_row < height and 0 <= zero_col + d_col < width]
+        direction, d_row, d_col = random.choice(options)
+        zero_row += d_row
+        zero_col += d_col
+        move_string += direction
+        last = direction
+    puzzle.update_puzzle(move_string)
+    return puzzle
+
+
+def random_puzzle(height, width):
+    """
+    Make a uniformly random solvable puzzle without replaying moves
+    Returns a Puzzle object
+    """
+    tiles = range(height * width)
+    random.shuffle(tiles)
+    grid = [tiles[row * width:(row + 1) * width] for row in range(height)]
+    puzzle = Puzzle(height, width, grid)
+    if not puzzle.is_solvable():
+        # Swapping two non-zero tiles flips the permutation parity
+        first, second = [(row, col) for row in range(height) for col in range(width)
+                         if grid[row][col] != 0][:2]
+        puzzle.set_number(first[0], first[1], grid[second[0]][second[1]])
+        puzzle.set_number(second[0], second[1], grid[first[0]][first[1]])
+    return puzzle
+
+
+def benchmark_solve_puzzle(sizes=(4, 10, 25, 50, 100, 200)):
+    """
+    Time solve_puzzle on random square boards of the given sizes
+    Time per move should stay roughly constant as the boards grow
+    """
+    for size in sizes:
+        puzzle = random_puzzle(size, size)
+        start = time.time()
+        move_string = puzzle.solve_puzzle()
+        elapsed = time.time() - start
+        assert puzzle.lower_row_invariant(0, 0)
+        print "%dx%d - moves: %d time: %.3f s per million moves: %.3f s" % (
+            size, size, len(move_string), elapsed, elapsed * 1e6 / max(len(move_string), 1))
+
+
+def compare_solvers(height, width, num_moves, table_directory="."):
+    """
+    Compare the phase solver, with and without the end game tables,
+    with the optimal solver on one scrambled puzzle
+    """
+    puzzle = scrambled_puzzle(height, width, num_moves)
+    print "Puzzle:"
+    print puzzle
+
+    phase_puzzle = puzzle.clone()
+    start = time.time()
+    phase_moves = phase_puzzle.solve_puzzle()
+    print "solve_puzzle   - moves:", len(phase_moves), "time:", time.time() - start
+
+    table_puzzle = puzzle.clone()
+    start = time.time()
+    table_moves = table_puzzle.solve_puzzle(table_directory)
+    print "end game table - moves:", len(table_moves), "time:", time.time() - start
+
+    simplified_puzzle = puzzle.clone()
+    simplified_puzzle.solve_puzzle_simplified()
+    stats = simplified_puzzle.get_solver_stats()
+    print "simplified     - moves:", stats["length"], "time:", stats["time"]
+
+    optimal_puzzle = puzzle.clone()
+    optimal_puzzle.solve_optimal()
+    stats = optimal_puzzle.get_solver_stats()
+    print "solve_optimal  - moves:", stats["length"], "time:", stats["time"], "nodes:", stats["nodes"]
+
+
+# Heuristic used by batch workers for optimal solving, set by init_batch_worker
+BATCH_HEURISTICS = {}
+
+
+def init_batch_worker(pdb_directory=None):
+    """
+    Set up a batch solving process, 4x4 boards use the shared pattern
+    databases when a directory with the 6-6-3 tables is given
+    """
+    BATCH_HEURISTICS.clear()
+    if pdb_directory != None:
+        databases = load_pattern_databases(4, 4, PARTITION_4X4, pdb_directory)
+        BATCH_HEURISTICS[(4, 4)] = PatternDatabaseHeuristic(databases)
+
+
+def solve_batch_job(job):
+    """
+    Solve one batch job (index, grid, optimal) in a worker process
+    Returns a tuple of the index, the move string and the solving time
+    """
+    index, grid, optimal = job
+    puzzle = Puzzle(len(grid), len(grid[0]), grid)
+    start = time.time()
+    if optimal:
+        heuristic = BATCH_HEURISTICS.get((puzzle.get_height(), puzzle.get_width()))
+        move_string = puzzle.solve_optimal(heuristic)
+    else:
+        move_string = puzzle.solve_puzzle()
+    return index, move_string, time.time() - start
+
+
+def solve_batch(grids, processes=None, optimal=False, pdb_directory=None):
+    """
+    Solve a stream of initial grids over a pool of processes
+    Unsolvable grids are rejected by their parity before reaching the pool
+    Generates (index, move string, time) tuples in completion order, with
+    a move string of None for unsolvable grids
+    """
+    if pdb_directory != None:
+        # Build any missing table once here, so the workers only map them
+        for database in load_pattern_databases(4, 4, PARTITION_4X4, pdb_directory):
+            database.close()
+
+    # Rejected grids and pool results both go through this queue, so each
+    # is reported as soon as it is known
+    output = Queue.Queue()
+
+    def solvable_jobs():
+        """
+        Jobs for the pool, reporting the unsolvable grids right away
+        """
+        for index, grid in enumerate(grids):
+            if Puzzle(len(grid), len(grid[0]), grid).is_solvable():
+                yield index, grid, optimal
+            else:
+                output.put((index, None, 0.0))
+
+    def collect_results(results):
+        """
+        Forward the pool results, then an error or None to finish
+        """
+        try:
+            for result in results:
+                output.put(result)
+        except Exception as error:  # pylint: disable=broad-except
+            output.put(error)
+        output.put(None)
+
+    pool = multiprocessing.Pool(processes, init_batch_worker, (pdb_directory,))
+    try:
+        collector = threading.Thread(target=collect_results,
+                                     args=(pool.imap_unordered(solve_batch_job, solvable_jobs()),))
+        collector.daemon = True
+        collector.start()
+        while True:
+            item = output.get()
+            if item == None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        pool.terminate()
+
+
+def batch_main(args):
+    """
+    Command line entry point: read one JSON grid per line from the input
+    and write one JSON result per line as soon as it is solved
+    """
+    parser = argparse.ArgumentParser(description="Solve Fifteen puzzles in batch")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="file with one JSON grid per line (default stdin)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of worker processes (default one per core)")
+    parser.add_argument("--optimal", action="store_true",
+                        help="use solve_optimal instead of solve_puzzle")
+    parser.add_argument("--pdb-dir", default=None,
+                        help="directory of the 4x4 pattern databases for --optimal")
+    options = parser.parse_args(args)
+
+    input_file = sys.stdin if options.input == "-" else open(options.input)
+    grids = (json.loads(line) for line in input_file if line.strip())
+    for index, move_string, elapsed in solve_batch(grids, options.processes,
+                                                   options.optimal, options.pdb_dir):
+        sys.stdout.write(json.dumps({"index": index,
+                                     "solvable": move_string != None,
+                                     "moves": move_string,
+                                     "time": elapsed}) + "\n")
+        sys.stdout.flush()
+
+# compare_solvers(3, 3, 40)
+# compare_solvers(4, 4, 40)
+# benchmark_solve_puzzle()
+
+# Building the 4x4 6-6-3 tables takes a long time, but only happens once
+# pdb_heuristic = PatternDatabaseHeuristic(load_pattern_databases(4, 4, PARTITION_4X4))
+# Partial tables for 5x5, the other tiles count their Manhattan distance
+# pdb_heuristic = PatternDatabaseHeuristic(load_pattern_databases(5, 5, ((1, 2, 5, 6, 10), (3, 4, 7, 8, 9))))
+# print scrambled_puzzle(4, 4, 80).solve_optimal(pdb_heuristic)
+
+# Batch solving from the command line:
+#   python "Mini Project \"Fifteen Puzzle\".py" batch [--optimal] [--processes N] grids.txt
+if __name__ == "__main__" and getattr(sys, "argv", [])[1:2] == ["batch"]:
+    batch_main(sys.argv[2:])
+
 # Start interactive simulation
 # poc_fifteen_gui.FifteenGUI(Puzzle(4, 4)) question10
 
@@ -2,8 +2,22 @@
 Clone of 2048 game.
 """
 
-import poc_2048_gui
 import random
+import time
+from collections import OrderedDict
+
+# The GUI only exists in CodeSkulptor; without it the file can still be
+# loaded under CPython for the simulators, players and benchmarks
+try:
+    import poc_2048_gui
+except ImportError:
+    poc_2048_gui = None
+
+# NumPy is only needed by the batch simulator
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Directions, DO NOT MODIFY
 UP = 1
@@ -18,35 +32,43 @@ OFFSETS = {UP: (1, 0),
            LEFT: (0, 1),
            RIGHT: (0, -1)}
 
+# Weights of the expectimax board evaluation; every row and column also
+# scores HEURISTIC_BASE, so that live boards stay positive, and a lost
+# board scores below the lowest value evaluate can return
+HEURISTIC_BASE = 200000.0
+HEURISTIC_EMPTY = 270.0
+HEURISTIC_MERGES = 700.0
+HEURISTIC_MONOTONIC = 47.0
+HEURISTIC_SUM = 11.0
+HEURISTIC_POWER = 3.5
+
+# Game record format: header, then one event per move or initial tile.
+# An event is a byte holding the direction (0 for an initial tile) and
+# the flags below, followed by the new tile square if there is one.
+RECORD_MAGIC = "2048"
+RECORD_HEADER = "<4sII"
+RECORD_NEW_TILE = 8
+RECORD_FOUR = 16
+RECORD_DIRECTION = 7
+
 def merge(line):
     """
     Helper function that merges a single row or column in 2048
     """
  
-    result_list = []
+    result_list = [0] * len(line)  # create an empty result list
     result_list_index = 0
-    number_of_zeros = 0 
+    last_value = 0  # last placed tile, if it can still merge
     
-    for dummy_index in range(len(line)): # create an empty result list
-        result_list.append(0)
-            
-    for dummy_value in line:  # slide all non-zero values to the left side
+    for dummy_value in line:  # slide non-zero values to the left, merging equal pairs on the way
         if dummy_value != 0:
-            result_list[result_list_index] = dummy_value
-            result_list_index += 1  
-            
-    for dummy_index in range(len(result_list)-1):  # merge equal tiles and count the number of zeros
-        if result_list[dummy_index] == result_list[dummy_index + 1]:
-            result_list[dummy_index] *= 2
-            result_list[dummy_index + 1] = 0 
-            number_of_zeros += 1
-    
-    while number_of_zeros >= 0:
-        for dummy_index in range(len(result_list)-1):  # slide all non-zero values to the left side one position for each
-            if result_list[dummy_index] == 0:          # zero in the list (work a more efficient way)
-                result_list[dummy_index] = result_list[dummy_index + 1]
-                result_list[dummy_index + 1] = 0
-        number_of_zeros -= 1
+            if dummy_value == last_value:
+                result_list[result_list_index - 1] *= 2
+                last_value = 0  # a merged tile does not merge again
+            else:
+                result_list[result_list_index] = dummy_value
+                result_list_index += 1
+                last_value = dummy_value
         
     return result_list
 
@@ -56,10 +78,16 @@ class TwentyFortyEight:
     Class to run the game logic.
     """
 
-    def __init__(self, grid_height, grid_width):
+    def __init__(self, grid_height, grid_width, seed=None, record=False):
         self._grid_height = grid_height
         self._grid_width = grid_width
         self._grid = []
+        # own random generator, so a seed makes the game reproducible
+        self._random = random.Random(seed)
+        # squares are stored in 2 bytes in game records when they fit
+        self._square_format = "<H" if grid_height * grid_width <= 1 << 16 else "<I"
+        self._record = bytearray() if record else None
+        self._in_move = False
         self.reset()
         self._limits = {UP : self._grid_height,
                          DOWN :self._grid_height,
@@ -75,13 +103,33 @@ class TwentyFortyEight:
         Reset the game so the grid is empty except for two
         initial tiles.
         """
-        # create a new board of HEIGHT X WIDTH dimensions
-        self._grid = [[0 for dummy_col in range(self._grid_width)] 
-                      for dummy_row in range(self._grid_height)]
+        self.clear()
+        if self._record != None:
+            self._record = bytearray()
         
         # add 2 initial tiles
         self.new_tile()
         self.new_tile()
+
+    def clear(self):
+        """
+        Empty the grid without adding any tile.
+        """
+        # create a new board of HEIGHT X WIDTH dimensions
+        self._grid = [[0 for dummy_col in range(self._grid_width)] 
+                      for dummy_row in range(self._grid_height)]
+
+        # index of the empty squares, kept up to date on every write
+        self._empty = [(row, col) for row in range(self._grid_height)
+                       for col in range(self._grid_width)]
+        self._empty_index = dict((cell, index) for index, cell in enumerate(self._empty))
+
+        # lines (rows for LEFT/RIGHT, columns for UP/DOWN) that merge would
+        # not change in that direction, cleared when one of their tiles changes
+        self._stable = {UP: [False] * self._grid_width,
+                        DOWN: [False] * self._grid_width,
+                        LEFT: [False] * self._grid_height,
+                        RIGHT: [False] * self._grid_height}
         
 
     def __str__(self):
@@ -126,25 +174,71 @@ class TwentyFortyEight:
         for step in range(steps):
             row = start[0] + step * direction[0]
             col = start[1] + step * direction[1]
-            self._grid[row][col] = merged[step]
+            self.write_tile(row, col, merged[step])
+
+    def write_tile(self, row, col, value):
+        """
+        Write one square, keeping the empty square index and the stable
+        line flags up to date
+        """
+        old_value = self._grid[row][col]
+        if old_value == value:
+            return
+        if (old_value == 0) != (value == 0):
+            self.mark_empty(row, col, value == 0)
+        self._grid[row][col] = value
+        self._stable[LEFT][row] = self._stable[RIGHT][row] = False
+        self._stable[UP][col] = self._stable[DOWN][col] = False
+
+    def mark_empty(self, row, col, empty):
+        """
+        Add a square to or remove it from the empty square index
+        """
+        cell = (row, col)
+        if empty:
+            self._empty_index[cell] = len(self._empty)
+            self._empty.append(cell)
+        else:
+            # swap the last empty square into the removed slot
+            index = self._empty_index.pop(cell)
+            last = self._empty.pop()
+            if last != cell:
+                self._empty[index] = last
+                self._empty_index[last] = index
 
     def move(self, direction):
         """
         Move all tiles in the given direction and add
         a new tile if any tiles moved.
         """
+        if self._record != None:
+            self._record.append(direction)
+        if self.slide(direction):
+            self._in_move = True
+            self.new_tile()
+            self._in_move = False
+
+    def slide(self, direction):
+        """
+        Move all tiles in the given direction without adding a new tile.
+        Returns whether any tile moved.
+        """
         
         changed = False
         steps = self._limits[direction]
+        stable = self._stable[direction]
         
-        for dummy_index in self._indices[direction]:
+        for line, dummy_index in enumerate(self._indices[direction]):
+            if stable[line]:  # untouched since merge last left it unchanged
+                continue
             temp_list = self.make_list(dummy_index, OFFSETS[direction], steps)
             merged = merge(temp_list)
             if temp_list != merged :
                 changed = True
-            self.modify(dummy_index, OFFSETS[direction], steps , merged)
-        if changed:
-            self.new_tile()
+                self.modify(dummy_index, OFFSETS[direction], steps , merged)
+            else:
+                stable[line] = True
+        return changed
 
     def new_tile(self):
         """
@@ -153,38 +247,1092 @@ class TwentyFortyEight:
         4 10% of the time.
         """
          
-        # randomly selects a row and a column
-        random_col = random.randrange(self._grid_width)
-        random_row = random.randrange(self._grid_height)
-        
-        # if the square isn't empty, repeat the process until an empty one is selected
-        while self._grid[random_row][random_col] != 0:
-            random_col = random.randrange(self._grid_width)
-            random_row = random.randrange(self._grid_height)
+        # a full board gets no new tile
+        if len(self._empty) == 0:
+            return
+         
+        # randomly selects an empty square from the index
+        random_row, random_col = self._empty[self._random.randrange(len(self._empty))]
         
         # randomly select a number between 0 and 9
-        random_tile = random.randrange(10) 
+        random_tile = self._random.randrange(10) 
         
         # if the number is 9, the new tile's value is 4 (10% of the times)
         # in other case the new tile's value is 2 (90% of the times)
         if random_tile == 9:
-            self._grid[random_row][random_col] = 4
+            self.set_tile(random_row, random_col, 4)
         else:
-            self._grid[random_row][random_col] = 2
+            self.set_tile(random_row, random_col, 2)
+
+        if self._record != None:
+            # game records are a CPython feature, CodeSkulptor has no struct
+            import struct
+            flags = RECORD_NEW_TILE | (RECORD_FOUR if random_tile == 9 else 0)
+            if self._in_move:
+                self._record[-1] |= flags
+            else:
+                self._record.append(flags)
+            self._record.extend(struct.pack(self._square_format,
+                                            random_row * self._grid_width + random_col))
         
 
     def set_tile(self, row, col, value):
         """
         Set the tile at position row, col to have the given value.
         """
-        self._grid[row][col] = value
+        self.write_tile(row, col, value)
 
     def get_tile(self, row, col):
         """
         Return the value of the tile at position row, col.
         """
         return self._grid[row][col]
+
+    def get_record(self):
+        """
+        Return the binary record of the moves and new tiles since the
+        last reset (tiles placed with set_tile are not recorded).
+        """
+        assert self._record != None, "game was created without record=True"
+        import struct
+        header = struct.pack(RECORD_HEADER, RECORD_MAGIC, self._grid_height, self._grid_width)
+        return header + str(self._record)
+
+    def legal_moves(self):
+        """
+        Return the list of directions that would move some tile, found by
+        looking for a tile next to an empty square or an equal tile in
+        front of it instead of trying the moves.
+        """
+        legal = []
+        for direction in (UP, DOWN, LEFT, RIGHT):
+            offset = OFFSETS[direction]
+            steps = self._limits[direction]
+            for start in self._indices[direction]:
+                line = self.make_list(start, offset, steps)
+                if self.line_can_move(line):
+                    legal.append(direction)
+                    break
+        return legal
+
+    def line_can_move(self, line):
+        """
+        Check whether merge would change the line (tiles move to the front)
+        """
+        for index in range(len(line) - 1):
+            if line[index + 1] != 0 and (line[index] == 0 or line[index] == line[index + 1]):
+                return True
+        return False
+
+    def is_game_over(self):
+        """
+        Check whether no move can change the board.
+        """
+        if len(self._empty) > 0:
+            return False
+        for row in range(self._grid_height):
+            for col in range(self._grid_width):
+                value = self._grid[row][col]
+                if col + 1 < self._grid_width and self._grid[row][col + 1] == value:
+                    return False
+                if row + 1 < self._grid_height and self._grid[row + 1][col] == value:
+                    return False
+        return True
+
+
+def test_slide(num_moves=2000, seed=0):
+    """
+    Play seeded random moves and check every slide against merging each
+    line of a copy of the grid from scratch, including the returned
+    changed flag and the empty square index, every line should print True
+    """
+    rng = random.Random(seed)
+    for grid_height, grid_width in ((4, 4), (3, 5), (6, 2)):
+        game = TwentyFortyEight(grid_height, grid_width, seed)
+        same = True
+        for dummy_move in range(num_moves):
+            if game.is_game_over():
+                game.reset()
+            direction = rng.choice((UP, DOWN, LEFT, RIGHT))
+            grid = [[game.get_tile(row, col) for col in range(grid_width)]
+                    for row in range(grid_height)]
+            lines = grid if direction in (LEFT, RIGHT) else [list(col) for col in zip(*grid)]
+            if direction in (RIGHT, DOWN):
+                lines = [merge(line[::-1])[::-1] for line in lines]
+            else:
+                lines = [merge(line) for line in lines]
+            expected = lines if direction in (LEFT, RIGHT) else [list(row) for row in zip(*lines)]
+            changed = game.slide(direction)
+            result = [[game.get_tile(row, col) for col in range(grid_width)]
+                      for row in range(grid_height)]
+            empty = [(row, col) for row in range(grid_height)
+                     for col in range(grid_width) if result[row][col] == 0]
+            same = (same and result == expected and changed == (expected != grid)
+                    and sorted(game._empty) == empty)
+            if changed:
+                game.new_tile()
+        print grid_height, grid_width, same
+
+
+# Lookup tables for the 4x4 bitboard: result row and score gained when a
+# 16 bit row of four 4 bit exponents (column 0 in the low bits) moves
+# left or right, built on first use
+ROW_TABLES = {}
+ROW_MASK = 0xFFFF
+
+
+def reverse_row(row):
+    """
+    Reverse the order of the four exponents of a 16 bit row
+    """
+    return (((row & 0xF) << 12) | ((row & 0xF0) << 4)
+            | ((row >> 4) & 0xF0) | ((row >> 12) & 0xF))
+
+
+def build_row_tables():
+    """
+    Build the left and right move tables for every possible 16 bit row
+    Returns a dictionary of the result rows and score gains by direction
+    """
+    left_rows = [0] * (ROW_MASK + 1)
+    left_scores = [0] * (ROW_MASK + 1)
+    for row in range(ROW_MASK + 1):
+        tiles = [(row >> (4 * col)) & 0xF for col in range(4) if (row >> (4 * col)) & 0xF]
+        merged = []
+        index = 0
+        while index < len(tiles):
+            # Two 32768 tiles do not merge: 65536 would not fit in 4 bits
+            if index + 1 < len(tiles) and tiles[index] == tiles[index + 1] and tiles[index] < 15:
+                merged.append(tiles[index] + 1)
+                left_scores[row] += 1 << (tiles[index] + 1)
+                index += 2
+            else:
+                merged.append(tiles[index])
+                index += 1
+        for col in range(len(merged)):
+            left_rows[row] |= merged[col] << (4 * col)
+    right_rows = [0] * (ROW_MASK + 1)
+    right_scores = [0] * (ROW_MASK + 1)
+    for row in range(ROW_MASK + 1):
+        reversed_row = reverse_row(row)
+        right_rows[row] = reverse_row(left_rows[reversed_row])
+        right_scores[row] = left_scores[reversed_row]
+    return {LEFT: (left_rows, left_scores), RIGHT: (right_rows, right_scores)}
+
+
+def transpose_board(board):
+    """
+    Transpose a 4x4 bitboard so columns can be moved with the row tables
+    Returns a 64 bit integer
+    """
+    part1 = board & 0xF0F00F0FF0F00F0F
+    part2 = board & 0x0000F0F00000F0F0
+    part3 = board & 0x0F0F00000F0F0000
+    board = part1 | (part2 << 12) | (part3 >> 12)
+    part1 = board & 0xFF00FF0000FF00FF
+    part2 = board & 0x00FF00FF00000000
+    part3 = board & 0x00000000FF00FF00
+    return part1 | (part2 >> 24) | (part3 << 24)
+
+
+def move_bitboard(board, direction):
+    """
+    Move every tile of a 4x4 bitboard in the given direction
+    Returns a tuple of the new board and the score gained
+    """
+    if not ROW_TABLES:
+        ROW_TABLES.update(build_row_tables())
+    transpose = direction == UP or direction == DOWN
+    if transpose:
+        board = transpose_board(board)
+    rows, scores = ROW_TABLES[LEFT if direction == UP or direction == LEFT else RIGHT]
+    result = 0
+    score = 0
+    for shift in (0, 16, 32, 48):
+        row = (board >> shift) & ROW_MASK
+        result |= rows[row] << shift
+        score += scores[row]
+    if transpose:
+        result = transpose_board(result)
+    return result, score
+
+
+def set_bitboard_tile(board, row, col, value):
+    """
+    Store the exponent of value at position row, col of a 4x4 bitboard,
+    values above 32768 are rejected
+    Returns a 64 bit integer
+    """
+    shift = 16 * row + 4 * col
+    exponent = len(bin(value)) - 3 if value else 0
+    # A larger tile would spill into the next square
+    assert exponent <= 15, "bitboard tiles stop at 32768, got " + str(value)
+    return (board & ~(0xF << shift)) | (exponent << shift)
+
+
+def new_bitboard_tile(board, rng):
+    """
+    Place a 2 (90%) or a 4 (10%) in a random empty square of a 4x4
+    bitboard, drawing from the random generator rng
+    Returns a 64 bit integer
+    """
+    empty_shifts = [shift for shift in range(0, 64, 4) if not (board >> shift) & 0xF]
+    if empty_shifts:
+        shift = rng.choice(empty_shifts)
+        exponent = 2 if rng.randrange(10) == 9 else 1
+        board |= exponent << shift
+    return board
+
+
+class BitboardTwentyFortyEight:
+    """
+    4x4 game logic on a 64 bit integer holding one 4 bit exponent per
+    tile (row r, column c at bits 16 * r + 4 * c), with the same
+    interface as TwentyFortyEight
+    Tiles stop at 32768: two 32768 tiles never merge, where
+    TwentyFortyEight would make a 65536 tile
+    """
+
+    def __init__(self, grid_height=4, grid_width=4, seed=None):
+        assert grid_height == 4 and grid_width == 4, "bitboard is 4x4 only"
+        self._grid_height = grid_height
+        self._grid_width = grid_width
+        self._random = random.Random(seed)
+        self._board = 0
+        self._score = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Reset the game so the grid is empty except for two
+        initial tiles.
+        """
+        self._board = 0
+        self._score = 0
+        self.new_tile()
+        self.new_tile()
+
+    def __str__(self):
+        """
+        Return a string representation of the grid for debugging.
+        """
+        string_board = ""
+        for row in range(self._grid_height):
+            string_board += str([self.get_tile(row, col)
+                                 for col in range(self._grid_width)]) + "\n"
+        return string_board
+
+    def get_grid_height(self):
+        """
+        Get the height of the board.
+        """
+        return self._grid_height
+
+    def get_grid_width(self):
+        """
+        Get the width of the board.
+        """
+        return self._grid_width
+
+    def get_board(self):
+        """
+        Get the packed 64 bit board.
+        """
+        return self._board
+
+    def get_score(self):
+        """
+        Get the sum of all merged tiles so far.
+        """
+        return self._score
+
+    def move(self, direction):
+        """
+        Move all tiles in the given direction and add
+        a new tile if any tiles moved.
+        """
+        board, score = move_bitboard(self._board, direction)
+        if board != self._board:
+            self._board = board
+            self._score += score
+            self.new_tile()
+
+    def new_tile(self):
+        """
+        Create a new tile in a randomly selected empty
+        square.  The tile should be 2 90% of the time and
+        4 10% of the time.
+        """
+        self._board = new_bitboard_tile(self._board, self._random)
+
+    def set_tile(self, row, col, value):
+        """
+        Set the tile at position row, col to have the given value.
+        """
+        self._board = set_bitboard_tile(self._board, row, col, value)
+
+    def get_tile(self, row, col):
+        """
+        Return the value of the tile at position row, col.
+        """
+        exponent = int((self._board >> (16 * row + 4 * col)) & 0xF)
+        return 1 << exponent if exponent else 0
     
 
 
-poc_2048_gui.run_gui(TwentyFortyEight(4, 4))
+def replay_game(record, num_moves=None):
+    """
+    Rebuild a game from a binary record made by get_record, stopping
+    after num_moves moves when given
+    Returns a TwentyFortyEight object
+    """
+    import struct
+    record = bytearray(record)
+    magic, grid_height, grid_width = struct.unpack_from(RECORD_HEADER, str(record[:12]))
+    assert magic == RECORD_MAGIC, "not a 2048 game record"
+    game = TwentyFortyEight(grid_height, grid_width)
+    game.clear()
+    square_format = "<H" if grid_height * grid_width <= 1 << 16 else "<I"
+    square_size = struct.calcsize(square_format)
+    position = struct.calcsize(RECORD_HEADER)
+    moves = 0
+    while position < len(record):
+        event = record[position]
+        if event & RECORD_DIRECTION and moves == num_moves:
+            break
+        position += 1
+        if event & RECORD_DIRECTION:
+            game.slide(event & RECORD_DIRECTION)
+            moves += 1
+        if event & RECORD_NEW_TILE:
+            square = struct.unpack(square_format, str(record[position:position + square_size]))[0]
+            position += square_size
+            game.set_tile(square / grid_width, square % grid_width,
+                          4 if event & RECORD_FOUR else 2)
+    return game
+
+
+def test_replay(num_moves=500, seed=0):
+    """
+    Record a seeded random game and check that replaying the record for
+    k moves gives the grid the game had after move k, every line should
+    print True
+    """
+    rng = random.Random(seed)
+    for grid_height, grid_width in ((4, 4), (5, 3)):
+        game = TwentyFortyEight(grid_height, grid_width, seed, record=True)
+        grids = [str(game)]
+        for dummy_move in range(num_moves):
+            if game.is_game_over():
+                break
+            game.move(rng.choice((UP, DOWN, LEFT, RIGHT)))
+            grids.append(str(game))
+        record = game.get_record()
+        same = str(replay_game(record)) == grids[-1]
+        for moves in range(len(grids)):
+            same = same and str(replay_game(record, moves)) == grids[moves]
+        print grid_height, grid_width, len(grids) - 1, same
+
+
+def board_from_game(game):
+    """
+    Pack the tiles of any 4x4 game object into a bitboard
+    Returns a 64 bit integer
+    """
+    if isinstance(game, BitboardTwentyFortyEight):
+        return game.get_board()
+    board = 0
+    for row in range(4):
+        for col in range(4):
+            board = set_bitboard_tile(board, row, col, game.get_tile(row, col))
+    return board
+
+
+def test_bitboard():
+    """
+    Test move_bitboard on single rows and against TwentyFortyEight.slide
+    on a whole grid, every line should end with True
+
+    [2, 0, 2, 4] moved left should return [4, 4, 0, 0]
+    [0, 0, 2, 2] moved left should return [4, 0, 0, 0]
+    [8, 16, 16, 8] moved left should return [8, 32, 8, 0]
+    [32768, 32768, 0, 0] moved left should stay [32768, 32768, 0, 0]
+    """
+    tests = [([2, 0, 2, 4], [4, 4, 0, 0]),
+             ([0, 0, 2, 2], [4, 0, 0, 0]),
+             ([2, 2, 2, 2], [4, 4, 0, 0]),
+             ([8, 16, 16, 8], [8, 32, 8, 0]),
+             ([32768, 32768, 0, 0], [32768, 32768, 0, 0])]
+    for line, expected in tests:
+        board = 0
+        for col in range(4):
+            board = set_bitboard_tile(board, 0, col, line[col])
+        moved = move_bitboard(board, LEFT)[0]
+        exponents = [int((moved >> (4 * col)) & 0xF) for col in range(4)]
+        result = [1 << exponent if exponent else 0 for exponent in exponents]
+        print result, result == expected
+
+    grid = [[2, 0, 2, 4], [4, 4, 8, 8], [0, 2, 0, 2], [16, 0, 16, 2]]
+    for direction in (UP, DOWN, LEFT, RIGHT):
+        game = TwentyFortyEight(4, 4, 0)
+        for row in range(4):
+            for col in range(4):
+                game.set_tile(row, col, grid[row][col])
+        moved = move_bitboard(board_from_game(game), direction)[0]
+        game.slide(direction)
+        print direction, moved == board_from_game(game)
+
+
+def build_heuristic_table():
+    """
+    Score every 16 bit row for empty tiles, possible merges, monotonicity
+    and tile sum, so a board evaluates with eight lookups
+    Returns a list indexed by row
+    """
+    table = [0.0] * (ROW_MASK + 1)
+    for row in range(ROW_MASK + 1):
+        exponents = [(row >> (4 * col)) & 0xF for col in range(4)]
+        empty = exponents.count(0)
+        merges = 0
+        previous = 0
+        counter = 0
+        for exponent in exponents:
+            if exponent == 0:
+                continue
+            if previous == exponent:
+                counter += 1
+            elif counter > 0:
+                merges += 1 + counter
+                counter = 0
+            previous = exponent
+        if counter > 0:
+            merges += 1 + counter
+        monotonic_left = 0.0
+        monotonic_right = 0.0
+        for col in range(3):
+            left = exponents[col] ** HEURISTIC_POWER
+            right = exponents[col + 1] ** HEURISTIC_POWER
+            if exponents[col] > exponents[col + 1]:
+                monotonic_left += left - right
+            else:
+                monotonic_right += right - left
+        total = sum(exponent ** HEURISTIC_POWER for exponent in exponents)
+        table[row] = (HEURISTIC_BASE + HEURISTIC_EMPTY * empty + HEURISTIC_MERGES * merges
+                      - HEURISTIC_MONOTONIC * min(monotonic_left, monotonic_right)
+                      - HEURISTIC_SUM * total)
+    return table
+
+
+class ExpectimaxPlayer:
+    """
+    Expectimax search over 4x4 bitboards with chance nodes for the 2 (90%)
+    and 4 (10%) tiles placed by new_tile and a bounded transposition cache
+    """
+
+    def __init__(self, depth=2, cache_size=100000):
+        """
+        Create a player searching depth moves ahead, remembering at most
+        cache_size evaluated positions
+        """
+        self._depth = depth
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._heuristic = build_heuristic_table()
+        # Eight row lookups per board, so nothing live can score this low
+        self._lost_value = 8 * min(self._heuristic) - 1.0
+        self._nodes = 0
+        self._search_time = 0.0
+        self._searches = 0
+
+    def evaluate(self, board):
+        """
+        Heuristic value of a board, summed over its rows and columns
+        """
+        value = 0.0
+        transposed = transpose_board(board)
+        for shift in (0, 16, 32, 48):
+            value += self._heuristic[(board >> shift) & ROW_MASK]
+            value += self._heuristic[(transposed >> shift) & ROW_MASK]
+        return value
+
+    def max_value(self, board, depth):
+        """
+        Value of the best move from a board with depth moves left
+        """
+        best = None
+        for direction in (UP, DOWN, LEFT, RIGHT):
+            new_board = move_bitboard(board, direction)[0]
+            if new_board != board:
+                value = self.chance_value(new_board, depth - 1)
+                if best == None or value > best:
+                    best = value
+        if best == None:
+            return self._lost_value
+        return best
+
+    def chance_value(self, board, depth):
+        """
+        Expected value over the tiles new_tile can place on a board
+        """
+        if depth == 0:
+            return self.evaluate(board)
+        key = (board, depth)
+        if key in self._cache:
+            # Refresh the entry so the least recently used one is evicted
+            value = self._cache.pop(key)
+            self._cache[key] = value
+            return value
+        self._nodes += 1
+        empty_shifts = [shift for shift in range(0, 64, 4) if not (board >> shift) & 0xF]
+        value = 0.0
+        for shift in empty_shifts:
+            value += 0.9 * self.max_value(board | (1 << shift), depth)
+            value += 0.1 * self.max_value(board | (2 << shift), depth)
+        value /= max(len(empty_shifts), 1)
+        self._cache[key] = value
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def choose_move(self, game):
+        """
+        Pick the direction with the best expected value for a 4x4 game
+        Returns a direction, or None when no move changes the board
+        """
+        start = time.time()
+        board = board_from_game(game)
+        best_direction = None
+        best_value = None
+        for direction in (UP, DOWN, LEFT, RIGHT):
+            new_board = move_bitboard(board, direction)[0]
+            if new_board != board:
+                value = self.chance_value(new_board, self._depth)
+                if best_value == None or value > best_value:
+                    best_direction = direction
+                    best_value = value
+        self._search_time += time.time() - start
+        self._searches += 1
+        return best_direction
+
+    def get_stats(self):
+        """
+        Search statistics: chance nodes expanded, nodes per second and
+        average move latency in seconds
+        Returns a dictionary
+        """
+        return {"nodes": self._nodes,
+                "nodes_per_second": self._nodes / max(self._search_time, 1e-9),
+                "average_latency": self._search_time / max(self._searches, 1),
+                "cache_entries": len(self._cache)}
+
+
+def test_expectimax():
+    """
+    Test that lost boards score below live ones, every line should
+    print True
+    """
+    player = ExpectimaxPlayer(1)
+    # No tile can move on a checkerboard of 2s and 4s
+    lost = 0
+    for row in range(4):
+        for col in range(4):
+            lost = set_bitboard_tile(lost, row, col, 2 if (row + col) % 2 else 4)
+    # Huge tiles with one gap score about as low as a live board can
+    crowded = 0
+    for row in range(4):
+        for col in range(4):
+            if row + col > 0:
+                crowded = set_bitboard_tile(crowded, row, col, 32768 if (row + col) % 2 else 16384)
+    print player.max_value(lost, 1) < player.evaluate(crowded)
+    print player.max_value(lost, 1) < player.evaluate(0)
+
+
+def play_expectimax(depth=2, cache_size=100000, max_moves=None):
+    """
+    Let the expectimax player play one bitboard game and print statistics
+    """
+    game = BitboardTwentyFortyEight()
+    player = ExpectimaxPlayer(depth, cache_size)
+    moves = 0
+    direction = player.choose_move(game)
+    while direction != None and (max_moves == None or moves < max_moves):
+        game.move(direction)
+        moves += 1
+        direction = player.choose_move(game)
+    stats = player.get_stats()
+    print "Moves:", moves, "score:", game.get_score()
+    print game
+    print "Nodes/sec:", stats["nodes_per_second"], "average latency:", stats["average_latency"]
+
+
+def random_rollout(board, rng, max_moves=None):
+    """
+    Play random moves from a 4x4 bitboard until the game is over or
+    max_moves moves were made
+    Returns the score gained
+    """
+    directions = [UP, DOWN, LEFT, RIGHT]
+    score = 0
+    moves = 0
+    while max_moves == None or moves < max_moves:
+        rng.shuffle(directions)
+        for direction in directions:
+            new_board, gained = move_bitboard(board, direction)
+            if new_board != board:
+                break
+        else:
+            return score
+        board = new_bitboard_tile(new_board, rng)
+        score += gained
+        moves += 1
+    return score
+
+
+def rollout_task(task):
+    """
+    Run rollouts after each of the given first moves in a worker process,
+    with its own seeded random generator.  The directions take turns, one
+    rollout each per round, so a deadline cuts all of them short evenly;
+    the first round always completes
+    Returns a list of (direction, total score, rollouts made) tuples
+    """
+    board, directions, num_rollouts, seed, deadline, max_moves = task
+    rng = random.Random(seed)
+    first_moves = [move_bitboard(board, direction) for direction in directions]
+    totals = [0] * len(directions)
+    rollouts = 0
+    while rollouts < num_rollouts and (rollouts == 0 or deadline == None
+                                       or time.time() < deadline):
+        for index, (first_board, first_score) in enumerate(first_moves):
+            totals[index] += first_score + random_rollout(
+                new_bitboard_tile(first_board, rng), rng, max_moves)
+        rollouts += 1
+    return [(directions[index], totals[index], rollouts) for index in range(len(directions))]
+
+
+class MonteCarloPlayer:
+    """
+    Pure Monte Carlo player for 4x4 games: for every legal direction it
+    averages the score of random playouts, spread over a process pool
+    """
+
+    def __init__(self, rollouts=100, processes=None, time_budget=None,
+                 seed=None, max_rollout_moves=None):
+        """
+        Create a player making up to rollouts playouts per direction,
+        within time_budget seconds per move when given
+        """
+        # process pools are a CPython feature, CodeSkulptor has no multiprocessing
+        import multiprocessing
+        self._rollouts = rollouts
+        self._processes = processes or multiprocessing.cpu_count()
+        self._time_budget = time_budget
+        self._random = random.Random(seed)
+        self._max_rollout_moves = max_rollout_moves
+        self._pool = multiprocessing.Pool(self._processes) if self._processes > 1 else None
+        self._total_rollouts = 0
+        self._total_time = 0.0
+
+    def choose_move(self, game):
+        """
+        Pick the direction with the best average playout score
+        Returns a direction, or None when no move changes the board
+        """
+        start = time.time()
+        board = board_from_game(game)
+        deadline = None if self._time_budget == None else start + self._time_budget
+        legal = [direction for direction in (UP, DOWN, LEFT, RIGHT)
+                 if move_bitboard(board, direction)[0] != board]
+        if not legal:
+            return None
+        # Split the playouts exactly into at most one task per process
+        # covering every direction, each with its own seed so a seeded
+        # player is reproducible
+        shares = [self._rollouts // self._processes
+                  + (1 if index < self._rollouts % self._processes else 0)
+                  for index in range(self._processes)]
+        tasks = [(board, legal, share, self._random.getrandbits(32),
+                  deadline, self._max_rollout_moves)
+                 for share in shares if share > 0]
+        if self._pool == None:
+            results = map(rollout_task, tasks)
+        else:
+            results = self._pool.map(rollout_task, tasks)
+
+        totals = dict((direction, [0, 0]) for direction in legal)
+        for task_results in results:
+            for direction, total, rollouts in task_results:
+                totals[direction][0] += total
+                totals[direction][1] += rollouts
+                self._total_rollouts += rollouts
+        self._total_time += time.time() - start
+        # Directions without rollouts have no average to compare
+        sampled = [direction for direction in legal if totals[direction][1] > 0] or legal
+        return max(sampled, key=lambda direction: float(totals[direction][0])
+                   / max(totals[direction][1], 1))
+
+    def get_stats(self):
+        """
+        Playout statistics: total rollouts and rollouts per second
+        Returns a dictionary
+        """
+        return {"rollouts": self._total_rollouts,
+                "rollouts_per_second": self._total_rollouts / max(self._total_time, 1e-9)}
+
+    def close(self):
+        """
+        Shut down the process pool
+        """
+        if self._pool != None:
+            self._pool.terminate()
+            self._pool = None
+
+
+def play_monte_carlo(rollouts=100, processes=None, time_budget=None, seed=None):
+    """
+    Let the Monte Carlo player play one bitboard game and print statistics
+    """
+    game = BitboardTwentyFortyEight(seed=seed)
+    player = MonteCarloPlayer(rollouts, processes, time_budget, seed)
+    try:
+        moves = 0
+        direction = player.choose_move(game)
+        while direction != None:
+            game.move(direction)
+            moves += 1
+            direction = player.choose_move(game)
+    finally:
+        player.close()
+    stats = player.get_stats()
+    print "Moves:", moves, "score:", game.get_score()
+    print game
+    print "Rollouts/sec:", stats["rollouts_per_second"]
+
+
+def merge_lines(lines):
+    """
+    Vectorized merge of every row of a 2D array, equivalent to calling
+    merge on each row
+    Returns a tuple of the merged array and the score gained per row
+    """
+    # Stable sort on "is empty" slides the tiles to the left in order
+    order = numpy.argsort(lines == 0, axis=1, kind="mergesort")
+    merged = numpy.take_along_axis(lines, order, axis=1)
+    scores = numpy.zeros(len(lines), dtype=lines.dtype)
+    for col in range(lines.shape[1] - 1):
+        pairs = (merged[:, col] == merged[:, col + 1]) & (merged[:, col] != 0)
+        merged[pairs, col] *= 2
+        merged[pairs, col + 1] = 0
+        scores += numpy.where(pairs, merged[:, col], 0)
+    order = numpy.argsort(merged == 0, axis=1, kind="mergesort")
+    return numpy.take_along_axis(merged, order, axis=1), scores
+
+
+class BatchTwentyFortyEight:
+    """
+    Many games of the same size held in one NumPy array of tile values,
+    all moved and given new tiles in single vectorized steps
+    """
+
+    def __init__(self, num_games, grid_height, grid_width, seed=None):
+        assert numpy != None, "the batch simulator needs NumPy"
+        self._num_games = num_games
+        self._grid_height = grid_height
+        self._grid_width = grid_width
+        self._random = numpy.random.RandomState(seed)
+        self._grids = numpy.zeros((num_games, grid_height, grid_width), dtype=numpy.int64)
+        self._scores = numpy.zeros(num_games, dtype=numpy.int64)
+        self.reset()
+
+    def reset(self):
+        """
+        Reset every game so the grid is empty except for two
+        initial tiles.
+        """
+        self._grids[:] = 0
+        self._scores[:] = 0
+        everyone = numpy.ones(self._num_games, dtype=bool)
+        self.new_tiles(everyone)
+        self.new_tiles(everyone)
+
+    def get_grids(self):
+        """
+        Get the array of all grids, indexed by game, row and column.
+        """
+        return self._grids
+
+    def get_scores(self):
+        """
+        Get the sum of all merged tiles so far for every game.
+        """
+        return self._scores
+
+    def get_tile(self, game, row, col):
+        """
+        Return the value of the tile at position row, col of one game.
+        """
+        return int(self._grids[game, row, col])
+
+    def oriented(self, grids, direction):
+        """
+        View of the grids in which the given direction moves tiles left
+        """
+        if direction == UP:
+            return grids.transpose(0, 2, 1)
+        elif direction == DOWN:
+            return grids.transpose(0, 2, 1)[:, :, ::-1]
+        elif direction == LEFT:
+            return grids
+        return grids[:, :, ::-1]
+
+    def moved(self, grids, direction):
+        """
+        Move every one of the given grids in one direction, without new tiles
+        Returns a tuple of the moved grids and the score gained per grid
+        """
+        view = self.oriented(grids, direction)
+        lines = view.reshape(-1, view.shape[2])
+        merged, scores = merge_lines(lines)
+        result = numpy.empty_like(grids)
+        self.oriented(result, direction)[:] = merged.reshape(view.shape)
+        return result, scores.reshape(len(grids), -1).sum(axis=1)
+
+    def move(self, directions):
+        """
+        Move every game in its own direction (a sequence with one entry
+        per game, or a single direction for all) and add a new tile to
+        the games whose tiles moved
+        Returns a boolean array of the games that changed
+        """
+        directions = numpy.broadcast_to(numpy.asarray(directions), (self._num_games,))
+        changed = numpy.zeros(self._num_games, dtype=bool)
+        for direction in (UP, DOWN, LEFT, RIGHT):
+            games = numpy.nonzero(directions == direction)[0]
+            if len(games) == 0:
+                continue
+            grids, scores = self.moved(self._grids[games], direction)
+            changed[games] = (grids != self._grids[games]).any(axis=(1, 2))
+            self._grids[games] = grids
+            self._scores[games] += scores
+        self.new_tiles(changed)
+        return changed
+
+    def new_tiles(self, games):
+        """
+        Create a new tile in a random empty square of each selected game
+        (a boolean array).  The tile should be 2 90% of the time and
+        4 10% of the time.
+        """
+        flat = self._grids.reshape(self._num_games, -1)
+        keys = self._random.random_sample(flat.shape)
+        keys[flat != 0] = -1.0
+        cells = keys.argmax(axis=1)
+        games = games & (keys.max(axis=1) >= 0.0)
+        values = numpy.where(self._random.random_sample(self._num_games) < 0.9, 2, 4)
+        rows = numpy.nonzero(games)[0]
+        flat[rows, cells[rows]] = values[rows]
+
+    def legal_moves(self):
+        """
+        Which directions change each game
+        Returns a boolean array indexed by game and direction - UP
+        """
+        legal = numpy.zeros((self._num_games, 4), dtype=bool)
+        for direction in (UP, DOWN, LEFT, RIGHT):
+            grids = self.moved(self._grids, direction)[0]
+            legal[:, direction - UP] = (grids != self._grids).any(axis=(1, 2))
+        return legal
+
+    def random_directions(self, legal):
+        """
+        Pick a uniformly random legal direction for each game, given the
+        result of legal_moves; games with no legal move get direction 0
+        Returns an integer array
+        """
+        keys = self._random.random_sample(legal.shape) * legal
+        directions = keys.argmax(axis=1) + UP
+        directions[~legal.any(axis=1)] = 0
+        return directions
+
+
+def simulate_random_games(num_games=10000, grid_height=4, grid_width=4, seed=None):
+    """
+    Play num_games games with uniformly random legal moves in one batch
+    until every game is over, and print score and max tile statistics
+    """
+    start = time.time()
+    batch = BatchTwentyFortyEight(num_games, grid_height, grid_width, seed)
+    moves = 0
+    legal = batch.legal_moves()
+    while legal.any():
+        moves += int(legal.any(axis=1).sum())
+        batch.move(batch.random_directions(legal))
+        legal = batch.legal_moves()
+    elapsed = time.time() - start
+    scores = batch.get_scores()
+    max_tiles = batch.get_grids().reshape(num_games, -1).max(axis=1)
+    print "Games:", num_games, "moves:", moves, "moves/sec:", moves / elapsed
+    print "Score mean:", scores.mean(), "max:", scores.max()
+    for tile in sorted(set(max_tiles.tolist())):
+        print "Max tile", tile, ":", (max_tiles == tile).mean()
+
+
+def benchmark_large_board(size=1000, num_moves=20):
+    """
+    Time random moves on a huge half full board, where most lines are
+    stable between moves
+    """
+    game = TwentyFortyEight(size, size)
+    for row in range(size):
+        for col in range(size):
+            if random.randrange(2):
+                game.set_tile(row, col, random.choice((2, 4, 8)))
+    start = time.time()
+    for dummy_move in range(num_moves):
+        game.move(random.choice((UP, DOWN, LEFT, RIGHT)))
+    print "%dx%d - %d moves, %.3f s per move" % (size, size, num_moves,
+                                               (time.time() - start) / num_moves)
+
+
+def benchmark_merge(lengths=(4, 8, 16, 64, 256), densities=(0.25, 0.5, 0.75, 1.0),
+                    num_lines=1000, repeat=3, seed=0):
+    """
+    Measure the merge used by TwentyFortyEight.slide on fixed random lines
+    of each length and tile density (fraction of non-zero tiles), best of
+    repeat runs
+    Returns a dictionary from benchmark name to lines merged per second
+    """
+    rng = random.Random(seed)
+    results = {}
+    for length in lengths:
+        for density in densities:
+            lines = [[rng.choice((2, 4, 8, 16)) if rng.random() < density else 0
+                      for dummy_col in range(length)]
+                     for dummy_line in range(num_lines)]
+            best = None
+            for dummy_run in range(repeat):
+                start = time.time()
+                for line in lines:
+                    merge(line)
+                elapsed = time.time() - start
+                if best == None or elapsed < best:
+                    best = elapsed
+            results["merge/length=%d/density=%.2f" % (length, density)] = num_lines / max(best, 1e-9)
+    return results
+
+
+def benchmark_move(sizes=(4, 8, 16, 32, 64), num_moves=200, repeat=3, seed=0):
+    """
+    Measure TwentyFortyEight.move on seeded games of each size, restarting
+    a game when it is over, best of repeat runs
+    Returns a dictionary from benchmark name to moves per second
+    """
+    results = {}
+    for size in sizes:
+        best = None
+        for dummy_run in range(repeat):
+            rng = random.Random(seed)
+            game = TwentyFortyEight(size, size, seed)
+            start = time.time()
+            for dummy_move in range(num_moves):
+                if game.is_game_over():
+                    game.reset()
+                game.move(rng.choice((UP, DOWN, LEFT, RIGHT)))
+            elapsed = time.time() - start
+            if best == None or elapsed < best:
+                best = elapsed
+        results["move/%dx%d" % (size, size)] = num_moves / max(best, 1e-9)
+    return results
+
+
+def bitboard_legal_moves(game):
+    """
+    Directions that change a BitboardTwentyFortyEight game
+    Returns a list of directions
+    """
+    board = game.get_board()
+    return [direction for direction in (UP, DOWN, LEFT, RIGHT)
+            if move_bitboard(board, direction)[0] != board]
+
+
+def benchmark_games(num_games=20, seed=0):
+    """
+    Measure full 4x4 games with seeded random legal moves, for the list
+    and the bitboard engines, each finding legal moves its own way
+    Returns a dictionary from benchmark name to games and moves per second
+    """
+    engines = (("list", lambda game_seed: TwentyFortyEight(4, 4, game_seed),
+                lambda game: game.legal_moves()),
+               ("bitboard", lambda game_seed: BitboardTwentyFortyEight(seed=game_seed),
+                bitboard_legal_moves))
+    results = {}
+    for name, make_game, legal_moves in engines:
+        rng = random.Random(seed)
+        moves = 0
+        start = time.time()
+        for game_number in range(num_games):
+            game = make_game(seed + game_number)
+            legal = legal_moves(game)
+            while legal:
+                game.move(rng.choice(legal))
+                moves += 1
+                legal = legal_moves(game)
+        elapsed = max(time.time() - start, 1e-9)
+        results["game/%s/games_per_second" % name] = num_games / elapsed
+        results["game/%s/moves_per_second" % name] = moves / elapsed
+    return results
+
+
+def compare_benchmarks(results, baseline, tolerance=0.2):
+    """
+    Compare throughputs with a baseline of the same form
+    Returns the sorted names that are more than tolerance slower
+    """
+    regressions = []
+    for name in sorted(results):
+        if name in baseline and results[name] < baseline[name] * (1.0 - tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def run_benchmarks(output_path=None, baseline_path=None, tolerance=0.2):
+    """
+    Run the merge, move and full game benchmarks, write the results as
+    JSON (printed when no output path is given) and report regressions
+    against a stored baseline
+    Returns the list of regressed benchmark names
+    """
+    # benchmarks are a CPython feature, CodeSkulptor has no json
+    import json
+    results = benchmark_merge()
+    results.update(benchmark_move())
+    results.update(benchmark_games())
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output_path == None:
+        print text
+    else:
+        with open(output_path, "w") as output_file:
+            output_file.write(text + "\n")
+
+    regressions = []
+    if baseline_path != None:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_benchmarks(results, baseline, tolerance)
+        for name in regressions:
+            print "REGRESSION", name, ":", results[name], "vs baseline", baseline[name]
+    return regressions
+
+
+if poc_2048_gui != None:
+    poc_2048_gui.run_gui(TwentyFortyEight(4, 4))
+# test_slide()
+# test_replay()
+# test_bitboard()
+# test_expectimax()
+# poc_2048_gui.run_gui(BitboardTwentyFortyEight(4, 4))
+# play_expectimax()
+# play_monte_carlo()
+# simulate_random_games()
+# benchmark_large_board()
+# run_benchmarks("2048_bench.json", "2048_baseline.json")
\ No newline at end of file
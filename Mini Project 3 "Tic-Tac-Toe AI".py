@@ -2,16 +2,33 @@
 Monte Carlo Tic-Tac-Toe Player
 """
 
+import copy
+import math
 import random
-import poc_ttt_gui
+import time
+from collections import OrderedDict
 import poc_ttt_provided as provided
 
+# The GUI only exists in CodeSkulptor; without it the file can still be
+# loaded under CPython for the pool, NumPy and benchmark players
+try:
+    import poc_ttt_gui
+except ImportError:
+    poc_ttt_gui = None
+
+# NumPy is only needed by the vectorized rollouts
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Constants for Monte Carlo simulator
 # You may change the values of these constants as desired, but
 #  do not change their names.
 NTRIALS = 100         # Number of trials to run
 SCORE_CURRENT = 1.0 # Score for squares played by the current player
 SCORE_OTHER = 1.0   # Score for squares played by the other player
+UCT_EXPLORATION = 1.4  # Exploration constant of the UCT player
     
 # Add your functions here.
 def mc_trial(board, player):
@@ -33,13 +50,14 @@ def mc_update_scores(scores, board, player):
     This function updates de scores grid, based on the winner and the moves
     """
     board_dim = board.get_dim()
-    if board.check_win() == provided.DRAW:
+    winner = board.check_win()
+    if winner == provided.DRAW:
         return
     else:
         for row in range(board_dim):
             for col in range(board_dim):
                 if board.square(row, col) != provided.EMPTY:
-                    if board.check_win() == player:
+                    if winner == player:
                         if board.square(row, col) == player:
                             scores[row][col] += SCORE_CURRENT
                         else:
@@ -49,10 +67,200 @@ def mc_update_scores(scores, board, player):
                             scores[row][col] -= SCORE_CURRENT
                         else:
                             scores[row][col] += SCORE_OTHER
+
+
+
+class TrialBoard:
+    """
+    Flat copy of a board for Monte Carlo trials.  Keeps how many squares
+    each player holds in every row, column and diagonal, so the winner is
+    known in constant time after each move instead of rescanning the
+    whole board with check_win
+    """
+
+    def __init__(self, board, reverse=False):
+        """
+        Copy board; reverse games score a completed line for the other player
+        """
+        dim = board.get_dim()
+        self._dim = dim
+        self._reverse = reverse
+        self._squares = [board.square(row, col)
+                         for row in range(dim) for col in range(dim)]
+        self._empty = [row * dim + col for (row, col) in board.get_empty_squares()]
+
+        # lines through each square: row, column and the diagonals
+        self._lines = []
+        for row in range(dim):
+            for col in range(dim):
+                lines = [row, dim + col]
+                if row == col:
+                    lines.append(2 * dim)
+                if row + col == dim - 1:
+                    lines.append(2 * dim + 1)
+                self._lines.append(lines)
+
+        self._counts = {provided.PLAYERX: [0] * (2 * dim + 2),
+                        provided.PLAYERO: [0] * (2 * dim + 2)}
+        for index, square in enumerate(self._squares):
+            if square != provided.EMPTY:
+                for line in self._lines[index]:
+                    self._counts[square][line] += 1
+        self._winner = board.check_win()
+
+    def clone(self):
+        """
+        Return a copy sharing the read-only line table
+        """
+        new_board = copy.copy(self)
+        new_board._squares = list(self._squares)
+        new_board._empty = list(self._empty)
+        new_board._counts = {provided.PLAYERX: list(self._counts[provided.PLAYERX]),
+                             provided.PLAYERO: list(self._counts[provided.PLAYERO])}
+        return new_board
+
+    def get_dim(self):
+        """
+        Return the board dimension
+        """
+        return self._dim
+
+    def square(self, row, col):
+        """
+        Return the contents of the square
+        """
+        return self._squares[row * self._dim + col]
+
+    def get_squares(self):
+        """
+        Return the flat row-major list of squares
+        """
+        return self._squares
+
+    def get_empty_squares(self):
+        """
+        Return the empty squares as (row, col) tuples
+        """
+        return [divmod(index, self._dim) for index in self._empty]
+
+    def check_win(self):
+        """
+        Return the winner, provided.DRAW or None while the game goes on
+        """
+        return self._winner
+
+    def move(self, row, col, player):
+        """
+        Place player on an empty square
+        """
+        index = row * self._dim + col
+        if self._squares[index] == provided.EMPTY:
+            self._empty.remove(index)
+            self.place(index, player)
+
+    def place(self, index, player):
+        """
+        Place player on the empty square at flat index, already removed
+        from the empty list, and update the winner
+        """
+        self._squares[index] = player
+        counts = self._counts[player]
+        for line in self._lines[index]:
+            counts[line] += 1
+            if counts[line] == self._dim:
+                if self._reverse:
+                    self._winner = provided.switch_player(player)
+                else:
+                    self._winner = player
+        if self._winner == None and not self._empty:
+            self._winner = provided.DRAW
+
+    def play_out(self, player, rng=random):
+        """
+        Play random moves from rng, player first, until the game is over.
+        Empty squares stay in row-major order so the random choices match
+        mc_trial on the provided board
+        """
+        empty = self._empty
+        while self._winner == None:
+            self.place(empty.pop(rng.randrange(len(empty))), player)
+            player = provided.switch_player(player)
+
+
+def detect_reverse(board):
+    """
+    Return True if board scores a completed line for the other player.
+    Fills clones of board with each player in turn; when neither fill
+    completes a line the game can only end in a draw and it does not matter
+    """
+    empty_squares = board.get_empty_squares()
+    for player in (provided.PLAYERX, provided.PLAYERO):
+        probe = board.clone()
+        for (row, col) in empty_squares:
+            probe.move(row, col, player)
+        winner = probe.check_win()
+        if winner == provided.PLAYERX or winner == provided.PLAYERO:
+            return winner != player
+    return False
+
+
+def mc_fast_update_scores(scores, trial_board, player, squared=None):
+    """
+    mc_update_scores for a finished TrialBoard, reading the winner once;
+    squared, when given, also accumulates the squared score updates
+    """
+    winner = trial_board.check_win()
+    if winner == provided.DRAW:
+        return
+    if winner == player:
+        player_score, other_score = SCORE_CURRENT, -SCORE_OTHER
+    else:
+        player_score, other_score = -SCORE_CURRENT, SCORE_OTHER
+    board_dim = trial_board.get_dim()
+    squares = trial_board.get_squares()
+    for row in range(board_dim):
+        score_row = scores[row]
+        offset = row * board_dim
+        for col in range(board_dim):
+            square = squares[offset + col]
+            if square == player:
+                update = player_score
+            elif square != provided.EMPTY:
+                update = other_score
+            else:
+                continue
+            score_row[col] += update
+            if squared != None:
+                squared[row][col] += update * update
+
+
+def mc_scores(trial_root, player, trials, rng=random):
+    """
+    Run trials from the TrialBoard trial_root and return the score grid
+    """
+    board_dim = trial_root.get_dim()
+    scores = [[0 for dummy_col in range(board_dim)]
+              for dummy_row in range(board_dim)]
+    for dummy_trial in range(trials):
+        current_board = trial_root.clone()
+        current_board.play_out(player, rng)
+        mc_fast_update_scores(scores, current_board, player)
+    return scores
+
+
+def mc_scores_task(task):
+    """
+    Worker entry point: run a share of the trials with a random
+    generator seeded for that share and return its score grid
+    """
+    trial_root, player, trials, seed = task
+    return mc_scores(trial_root, player, trials, random.Random(seed))
+
                         
-def get_best_move(board, scores):
+def get_best_move(board, scores, rng=random):
     """
-    This function returns the best move available given the current board and the scores
+    This function returns the best move available given the current board and the scores,
+    breaking ties with rng
     """
         
     empty_squares = board.get_empty_squares()
@@ -69,30 +277,732 @@ def get_best_move(board, scores):
                 max_score = score
                 max_list = []
                 max_list.append(square)
-        return random.choice(max_list)
+        return rng.choice(max_list)
         
     else:
         return 
 
-def mc_move(board, player, trials):
+def mc_move(board, player, trials, seed=None):
     """
     This function returns the move for the machine player given by the Monte Carlo simulation
+    A seed makes the move reproducible
     """
-    board_dim = board.get_dim()
-    scores = [[0 for dummy_col in range(board_dim)] 
-                           for dummy_row in range(board_dim)]
-    for dummy_trial in range(trials):
-        current_board = board.clone()
-        mc_trial(current_board, player)
-        mc_update_scores(scores, current_board, player)
-    
-    return get_best_move(board, scores)
+    trial_root = TrialBoard(board, detect_reverse(board))
+    if seed == None:
+        return get_best_move(board, mc_scores(trial_root, player, trials))
+    rng = random.Random(seed)
+    return get_best_move(board, mc_scores(trial_root, player, trials, rng), rng)
+
+
+class ParallelMonteCarloPlayer:
+    """
+    mc_move with the trials split across a persistent process pool, so
+    the pool starts once per player rather than once per move
+    """
+
+    def __init__(self, processes=None, seed=None):
+        """
+        Create a player with its pool; a seed makes its moves reproducible
+        for a given number of processes
+        """
+        # process pools are a CPython feature, CodeSkulptor has no multiprocessing
+        import multiprocessing
+        self._processes = processes or multiprocessing.cpu_count()
+        self._random = random.Random(seed)
+        self._pool = multiprocessing.Pool(self._processes) if self._processes > 1 else None
+
+    def choose_move(self, board, player, trials):
+        """
+        Split the trials into one share per process, share i seeded with
+        a per move seed plus i, and sum the grids in share order; has the
+        signature of mc_move for provided.play_game
+        """
+        trial_root = TrialBoard(board, detect_reverse(board))
+        seed = self._random.getrandbits(31)
+        shares = [trials // self._processes + (1 if share < trials % self._processes else 0)
+                  for share in range(self._processes)]
+        tasks = [(trial_root, player, shares[share], seed + share)
+                 for share in range(self._processes) if shares[share] > 0]
+        if self._pool == None:
+            grids = map(mc_scores_task, tasks)
+        else:
+            grids = self._pool.map(mc_scores_task, tasks)
+
+        board_dim = board.get_dim()
+        scores = [[0 for dummy_col in range(board_dim)]
+                  for dummy_row in range(board_dim)]
+        for grid in grids:
+            for row in range(board_dim):
+                for col in range(board_dim):
+                    scores[row][col] += grid[row][col]
+        return get_best_move(board, scores, self._random)
+
+    def close(self):
+        """
+        Shut down the process pool
+        """
+        if self._pool != None:
+            self._pool.terminate()
+            self._pool = None
      
 
 
+class TrialEngine:
+    """
+    Allocation-free trials from one position.  A single flat board and
+    line count buffer is reused for every trial: empty squares are drawn
+    by swap-remove from an in-place list, the squares played are kept in
+    an undo log, and each trial is scored from the log and undone
+    """
+
+    def __init__(self, board, player, reverse=False):
+        """
+        Prepare trials from board with player to move
+        """
+        dim = board.get_dim()
+        self._dim = dim
+        self._player = player
+        self._other = provided.switch_player(player)
+        self._reverse = reverse
+        self._squares = [board.square(row, col)
+                         for row in range(dim) for col in range(dim)]
+        self._empty = [row * dim + col for (row, col) in board.get_empty_squares()]
+        self._log = [0] * len(self._empty)
+        self._scores = [0.0] * (dim * dim)
+        self._wins = 0                  # trials won by player minus trials lost
+
+        # lines through each square; counts for player are stored at line,
+        # for the other player at line + self._stride
+        self._stride = 2 * dim + 2
+        self._lines = []
+        for row in range(dim):
+            for col in range(dim):
+                lines = [row, dim + col]
+                if row == col:
+                    lines.append(2 * dim)
+                if row + col == dim - 1:
+                    lines.append(2 * dim + 1)
+                self._lines.append(lines)
+        self._start_counts = [0] * (2 * self._stride)
+        for index, square in enumerate(self._squares):
+            if square != provided.EMPTY:
+                offset = 0 if square == player else self._stride
+                for line in self._lines[index]:
+                    self._start_counts[offset + line] += 1
+        self._counts = list(self._start_counts)
+
+    def run(self, trials, rng=random):
+        """
+        Play trials random games, adding their results to the scores
+        The per trial loops use xrange so no step list is built
+        """
+        dim, stride = self._dim, self._stride
+        squares, counts, lines = self._squares, self._counts, self._lines
+        start_counts = self._start_counts
+        empty, log, scores = self._empty, self._log, self._scores
+        player, other = self._player, self._other
+        randrange = rng.randrange
+        for dummy_trial in xrange(trials):
+            left = len(empty)
+            placed = 0
+            mover, offset = player, 0
+            winner = None
+            while left:
+                pick = randrange(left)
+                left -= 1
+                index = empty[pick]
+                empty[pick] = empty[left]
+                empty[left] = index
+                squares[index] = mover
+                log[placed] = index
+                placed += 1
+                for line in lines[index]:
+                    counts[offset + line] += 1
+                    if counts[offset + line] == dim:
+                        winner = mover
+                if winner != None:
+                    break
+                if mover == player:
+                    mover, offset = other, stride
+                else:
+                    mover, offset = player, 0
+
+            # player made the even numbered moves of the log
+            if winner != None:
+                if (winner == player) != self._reverse:
+                    player_score, other_score = SCORE_CURRENT, -SCORE_OTHER
+                    self._wins += 1
+                else:
+                    player_score, other_score = -SCORE_CURRENT, SCORE_OTHER
+                    self._wins -= 1
+                for step in xrange(0, placed, 2):
+                    scores[log[step]] += player_score
+                for step in xrange(1, placed, 2):
+                    scores[log[step]] += other_score
+
+            # undo the trial: clear the logged squares and copy the line
+            # counts back in place; empty still holds every empty square
+            for step in xrange(placed):
+                squares[log[step]] = provided.EMPTY
+            counts[:] = start_counts
+
+    def get_scores(self):
+        """
+        Return the score grid of all trials so far, as mc_update_scores
+        would have accumulated it
+        """
+        dim = self._dim
+        scores = list(self._scores)
+        for index, square in enumerate(self._squares):
+            if square == self._player:
+                scores[index] += SCORE_CURRENT * self._wins
+            elif square == self._other:
+                scores[index] -= SCORE_OTHER * self._wins
+        return [scores[row * dim:(row + 1) * dim] for row in range(dim)]
+
+
+def mc_engine_move(board, player, trials):
+    """
+    mc_move using the allocation-free TrialEngine
+    """
+    engine = TrialEngine(board, player, detect_reverse(board))
+    engine.run(trials)
+    return get_best_move(board, engine.get_scores())
+
+
+def benchmark_trials(dims=(3, 7, 11, 15), trials=200, seed=0):
+    """
+    Time trials from an empty board of each size with the provided board
+    (clone, mc_trial, mc_update_scores), TrialBoard and TrialEngine
+    Returns a dictionary from benchmark name to trials per second
+    """
+    results = {}
+    for dim in dims:
+        board = provided.TTTBoard(dim)
+        player = provided.PLAYERX
+        scores = [[0 for dummy_col in range(dim)] for dummy_row in range(dim)]
+        random.seed(seed)
+        start = time.time()
+        for dummy_trial in range(trials):
+            current_board = board.clone()
+            mc_trial(current_board, player)
+            mc_update_scores(scores, current_board, player)
+        results["provided/%dx%d" % (dim, dim)] = trials / max(time.time() - start, 1e-9)
+
+        start = time.time()
+        mc_scores(TrialBoard(board), player, trials, random.Random(seed))
+        results["trial_board/%dx%d" % (dim, dim)] = trials / max(time.time() - start, 1e-9)
+
+        start = time.time()
+        TrialEngine(board, player).run(trials, random.Random(seed))
+        results["engine/%dx%d" % (dim, dim)] = trials / max(time.time() - start, 1e-9)
+    for name in sorted(results):
+        print name, "%.0f trials/sec" % results[name]
+    return results
+
+
+def symmetry_permutations(dim):
+    """
+    The 8 rotations and reflections of a dim x dim board, each as a list
+    mapping every flat square index to its image
+    """
+    last = dim - 1
+    maps = [lambda row, col: (row, col),
+            lambda row, col: (col, last - row),
+            lambda row, col: (last - row, last - col),
+            lambda row, col: (last - col, row),
+            lambda row, col: (row, last - col),
+            lambda row, col: (last - row, col),
+            lambda row, col: (col, row),
+            lambda row, col: (last - col, last - row)]
+    permutations = []
+    for square_map in maps:
+        permutation = []
+        for row in range(dim):
+            for col in range(dim):
+                image_row, image_col = square_map(row, col)
+                permutation.append(image_row * dim + image_col)
+        permutations.append(permutation)
+    return permutations
+
+
+def canonical_squares(squares, permutations):
+    """
+    Smallest image of the flat squares under the symmetries
+    Returns the image as a tuple and the permutation producing it
+    """
+    best, best_permutation = None, None
+    for permutation in permutations:
+        image = [0] * len(squares)
+        for index, square in enumerate(squares):
+            image[permutation[index]] = square
+        image = tuple(image)
+        if best == None or image < best:
+            best, best_permutation = image, permutation
+    return best, best_permutation
+
+
+class CachedMonteCarloPlayer:
+    """
+    Monte Carlo player remembering the score grids of recent positions.
+    Positions are keyed on the smallest of their 8 symmetric images, so
+    rotated and reflected repeats share one entry whose grid is stored
+    in canonical order and mapped back through the symmetry
+    """
+
+    def __init__(self, cache_size=10000, refine_trials=10):
+        """
+        Create a player remembering at most cache_size positions; a
+        repeated position runs refine_trials more trials instead of trials
+        """
+        self._cache_size = cache_size
+        self._refine_trials = refine_trials
+        self._cache = OrderedDict()
+        self._permutations = {}
+        self._hits = 0
+        self._misses = 0
+
+    def choose_move(self, board, player, trials):
+        """
+        Return the best move from the accumulated scores; has the
+        signature of mc_move for provided.play_game
+        """
+        dim = board.get_dim()
+        if dim not in self._permutations:
+            self._permutations[dim] = symmetry_permutations(dim)
+        squares = [board.square(row, col) for row in range(dim) for col in range(dim)]
+        reverse = detect_reverse(board)
+        image, permutation = canonical_squares(squares, self._permutations[dim])
+        key = (image, player, reverse)
+
+        if key in self._cache:
+            # Refresh the entry so the least recently used one is evicted
+            canonical = self._cache.pop(key)
+            trials = self._refine_trials
+            self._hits += 1
+        else:
+            canonical = [0.0] * (dim * dim)
+            self._misses += 1
+        engine = TrialEngine(board, player, reverse)
+        engine.run(trials)
+        new_scores = engine.get_scores()
+        for index in range(dim * dim):
+            canonical[permutation[index]] += new_scores[index // dim][index % dim]
+        self._cache[key] = canonical
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+        scores = [[canonical[permutation[row * dim + col]] for col in range(dim)]
+                  for row in range(dim)]
+        return get_best_move(board, scores)
+
+    def get_stats(self):
+        """
+        Cache statistics: hits, misses and entries
+        Returns a dictionary
+        """
+        return {"hits": self._hits,
+                "misses": self._misses,
+                "cache_entries": len(self._cache)}
+
+
+def trial_score(trial_board, player, row, col):
+    """
+    Score update mc_update_scores gives one square of a finished trial
+    """
+    winner = trial_board.check_win()
+    square = trial_board.square(row, col)
+    if winner == provided.DRAW or square == provided.EMPTY:
+        return 0.0
+    sign = 1.0 if winner == player else -1.0
+    if square == player:
+        return sign * SCORE_CURRENT
+    return -sign * SCORE_OTHER
+
+
+def mc_move_anytime(board, player, time_budget, confidence_z=3.0, min_trials=50,
+                    max_trials=None, seed=None):
+    """
+    Run trials until time_budget seconds have passed, max_trials is
+    reached, or the leading empty square is decisively ahead of the
+    runner-up.  Both squares are scored by the same trials, so the test
+    follows their per-trial score difference: once the same pair has led
+    for min_trials trials, the mean difference must exceed confidence_z
+    standard errors
+
+    Returns (move, trials, confidence), where confidence is the grid of
+    confidence_z standard errors of each empty square's mean score per
+    trial (0.0 for occupied squares), and the move is None when the board
+    is full
+    """
+    deadline = time.time() + time_budget
+    rng = random.Random(seed)
+    board_dim = board.get_dim()
+    confidence = [[0.0 for dummy_col in range(board_dim)] for dummy_row in range(board_dim)]
+    empty_squares = board.get_empty_squares()
+    if len(empty_squares) == 0:
+        return None, 0, confidence
+
+    trial_root = TrialBoard(board, detect_reverse(board))
+    scores = [[0.0 for dummy_col in range(board_dim)] for dummy_row in range(board_dim)]
+    squared = [[0.0 for dummy_col in range(board_dim)] for dummy_row in range(board_dim)]
+    trials = 0
+    # leader and runner-up, and the statistics of their score difference
+    pair = None
+    pair_trials, pair_sum, pair_squared = 0, 0.0, 0.0
+
+    while len(empty_squares) > 1:
+        # check the clock and the margin every few trials only
+        for dummy_trial in range(10):
+            current_board = trial_root.clone()
+            current_board.play_out(player, rng)
+            mc_fast_update_scores(scores, current_board, player, squared)
+            if pair != None:
+                difference = (trial_score(current_board, player, pair[0][0], pair[0][1]) -
+                              trial_score(current_board, player, pair[1][0], pair[1][1]))
+                pair_trials += 1
+                pair_sum += difference
+                pair_squared += difference * difference
+        trials += 10
+        if time.time() >= deadline or (max_trials != None and trials >= max_trials):
+            break
+        if trials < min_trials:
+            continue
+        ranked = sorted(empty_squares, key=lambda square: -scores[square[0]][square[1]])
+        if pair != (ranked[0], ranked[1]):
+            pair = (ranked[0], ranked[1])
+            pair_trials, pair_sum, pair_squared = 0, 0.0, 0.0
+            continue
+        if pair_trials < min_trials:
+            continue
+        margin = pair_sum / pair_trials
+        variance = max(pair_squared / pair_trials - margin * margin, 0.0) / pair_trials
+        if margin > 0 and margin * margin > confidence_z * confidence_z * variance:
+            break
+
+    for (row, col) in empty_squares:
+        if trials > 0:
+            mean = scores[row][col] / trials
+            variance = max(squared[row][col] / trials - mean * mean, 0.0)
+            confidence[row][col] = confidence_z * math.sqrt(variance / trials)
+    best_score = max(scores[row][col] for (row, col) in empty_squares)
+    move = rng.choice([(row, col) for (row, col) in empty_squares
+                       if scores[row][col] == best_score])
+    return move, trials, confidence
+
+
+def vector_scores_from_orders(board, player, orders, reverse=False):
+    """
+    Score a batch of trials given as an integer array orders, where
+    orders[trial, step] is the index into board.get_empty_squares() of
+    the square played at that step, player moving on even steps
+
+    Every line is resolved for all trials at once: it is completed by a
+    player when its empty squares all fall on that player's steps, at
+    the latest of those steps, and the earliest completed line decides
+    the trial.  Returns the summed score grid as a NumPy array
+    """
+    board_dim = board.get_dim()
+    other = provided.switch_player(player)
+    empty_squares = board.get_empty_squares()
+    num_trials, num_empty = orders.shape
+    empty_index = {}
+    for index, square in enumerate(empty_squares):
+        empty_index[square] = index
+
+    steps = numpy.argsort(orders, axis=1)
+    by_player = steps % 2 == 0
+
+    lines = [[(row, col) for col in range(board_dim)] for row in range(board_dim)]
+    lines += [[(row, col) for row in range(board_dim)] for col in range(board_dim)]
+    lines.append([(index, index) for index in range(board_dim)])
+    lines.append([(index, board_dim - 1 - index) for index in range(board_dim)])
+
+    win_step = numpy.full(num_trials, num_empty)
+    owner = numpy.zeros(num_trials, dtype=int)
+    for line in lines:
+        cells = [empty_index[square] for square in line if square in empty_index]
+        held = set(board.square(row, col) for (row, col) in line
+                   if (row, col) not in empty_index)
+        if not cells or len(held) > 1:
+            continue
+        done_step = steps[:, cells].max(axis=1)
+        for line_player, on_steps in ((player, by_player), (other, ~by_player)):
+            if held and line_player not in held:
+                continue
+            better = on_steps[:, cells].all(axis=1) & (done_step < win_step)
+            win_step[better] = done_step[better]
+            owner[better] = line_player
+
+    if reverse:
+        winner = numpy.where(owner == player, other, player)
+    else:
+        winner = numpy.where(owner == player, player, other)
+    sign = numpy.where(owner == 0, 0.0, numpy.where(winner == player, 1.0, -1.0))
+
+    played = steps <= win_step[:, numpy.newaxis]
+    scores = numpy.zeros((board_dim, board_dim))
+    empty_rows = [row for (row, dummy_col) in empty_squares]
+    empty_cols = [col for (dummy_row, col) in empty_squares]
+    scores[empty_rows, empty_cols] = (SCORE_CURRENT * sign.dot(played & by_player)
+                                      - SCORE_OTHER * sign.dot(played & ~by_player))
+    total = sign.sum()
+    for row in range(board_dim):
+        for col in range(board_dim):
+            if board.square(row, col) == player:
+                scores[row, col] = SCORE_CURRENT * total
+            elif board.square(row, col) == other:
+                scores[row, col] = -SCORE_OTHER * total
+    return scores
+
+
+def mc_vector_scores(board, player, trials, seed=None, batch_size=4096):
+    """
+    Run trials as NumPy batches of random move orders and return the
+    score grid get_best_move expects
+    """
+    assert numpy != None, "the vectorized rollouts need NumPy"
+    rng = numpy.random.RandomState(seed)
+    reverse = detect_reverse(board)
+    num_empty = len(board.get_empty_squares())
+    board_dim = board.get_dim()
+    scores = numpy.zeros((board_dim, board_dim))
+    while trials > 0:
+        batch = min(trials, batch_size)
+        orders = numpy.argsort(rng.random_sample((batch, num_empty)), axis=1)
+        scores += vector_scores_from_orders(board, player, orders, reverse)
+        trials -= batch
+    return scores.tolist()
+
+
+def mc_vector_move(board, player, trials):
+    """
+    mc_move using the vectorized rollouts
+    """
+    return get_best_move(board, mc_vector_scores(board, player, trials))
+
+
+def test_vector_scores(trials=20000, seed=0):
+    """
+    Compare mc_vector_scores with mc_scores on a fixed 3x3 position: each
+    square's average score per trial should agree within four standard
+    errors, given a score per trial between -1 and 1 times its weight.
+    Should print True
+    """
+    board = provided.TTTBoard(3)
+    board.move(1, 1, provided.PLAYERX)
+    board.move(0, 0, provided.PLAYERO)
+    board.move(0, 2, provided.PLAYERX)
+    player = provided.PLAYERO
+    trial_root = TrialBoard(board, detect_reverse(board))
+    serial = mc_scores(trial_root, player, trials, random.Random(seed))
+    vector = mc_vector_scores(board, player, trials, seed)
+    weight = max(SCORE_CURRENT, SCORE_OTHER)
+    tolerance = 4.0 * weight * math.sqrt(2.0 / trials)
+    same = True
+    for row in range(3):
+        for col in range(3):
+            difference = abs(serial[row][col] - vector[row][col]) / trials
+            same = same and difference < tolerance
+    print same
+
+
+class UCTPlayer:
+    """
+    Monte Carlo tree search player using UCT.  Node statistics live in
+    parallel arrays indexed by node, children of a node are stored
+    contiguously, and the subtree of the position reached on the next
+    turn is kept instead of starting over
+    """
+
+    def __init__(self, exploration=UCT_EXPLORATION, seed=None, max_nodes=1000000):
+        """
+        Create a player; max_nodes bounds the tree, which then stops growing
+        """
+        self._exploration = exploration
+        self._random = random.Random(seed)
+        self._max_nodes = max_nodes
+        self._root_squares = None
+        self._root_player = None
+        self._clear()
+        self._total_iterations = 0
+        self._reused_visits = 0
+
+    def _clear(self):
+        """
+        Empty the tree down to a fresh root
+        """
+        # typed arrays are a CPython feature, CodeSkulptor has no array module
+        from array import array
+        self._move = array("i", [-1])          # square played to reach the node
+        self._parent = array("i", [-1])
+        self._first_child = array("i", [-1])   # -1 until expanded
+        self._num_children = array("i", [0])
+        self._visits = array("i", [0])
+        self._wins = array("d", [0.0])         # for the player who moved into the node
+
+    def _add_node(self, move, parent):
+        """
+        Append an unexpanded node and return its index
+        """
+        self._move.append(move)
+        self._parent.append(parent)
+        self._first_child.append(-1)
+        self._num_children.append(0)
+        self._visits.append(0)
+        self._wins.append(0.0)
+        return len(self._move) - 1
+
+    def _reroot(self, node):
+        """
+        Keep only the subtree under node, renumbered breadth first so the
+        children of every node stay contiguous, with node as the root
+        """
+        old = (self._move, self._first_child, self._num_children,
+               self._visits, self._wins)
+        self._clear()
+        self._visits[0] = old[3][node]
+        self._wins[0] = old[4][node]
+        queue = [(node, 0)]
+        for old_node, new_node in queue:
+            first, count = old[1][old_node], old[2][old_node]
+            if first < 0:
+                continue
+            self._first_child[new_node] = len(self._move)
+            self._num_children[new_node] = count
+            for child in range(first, first + count):
+                new_child = self._add_node(old[0][child], new_node)
+                self._visits[new_child] = old[3][child]
+                self._wins[new_child] = old[4][child]
+                queue.append((child, new_child))
+
+    def _find_root(self, squares, player):
+        """
+        Reuse the subtree for squares if it grows from the previous root
+        by moves alternating from the previous player, else start over
+        """
+        if self._root_squares == None or len(self._root_squares) != len(squares):
+            self._clear()
+            return
+        added = [index for index in range(len(squares))
+                 if squares[index] != self._root_squares[index]]
+        node = 0
+        mover = self._root_player
+        for dummy_move in range(len(added)):
+            moves = [index for index in added if squares[index] == mover]
+            child = -1
+            if len(moves) == 1 and self._first_child[node] >= 0:
+                first = self._first_child[node]
+                for candidate in range(first, first + self._num_children[node]):
+                    if self._move[candidate] == moves[0]:
+                        child = candidate
+            if child < 0:
+                self._clear()
+                return
+            added.remove(moves[0])
+            node = child
+            mover = provided.switch_player(mover)
+        if len(added) == 0 and mover == player and all(
+                self._root_squares[index] == squares[index] or
+                self._root_squares[index] == provided.EMPTY
+                for index in range(len(squares))):
+            if node != 0:
+                self._reroot(node)
+                self._reused_visits += self._visits[0]
+        else:
+            self._clear()
+
+    def _select(self, node):
+        """
+        Child of an expanded node with the best UCT value, unvisited first
+        """
+        visits, wins = self._visits, self._wins
+        log_visits = math.log(max(visits[node], 1))
+        first = self._first_child[node]
+        best, best_value = first, None
+        for child in range(first, first + self._num_children[node]):
+            if visits[child] == 0:
+                return child
+            value = (wins[child] / visits[child] +
+                     self._exploration * math.sqrt(log_visits / visits[child]))
+            if best_value == None or value > best_value:
+                best, best_value = child, value
+        return best
+
+    def choose_move(self, board, player, trials):
+        """
+        Grow the tree by trials iterations and return the most visited
+        move; has the signature of mc_move for provided.play_game
+        """
+        dim = board.get_dim()
+        squares = [board.square(row, col) for row in range(dim) for col in range(dim)]
+        self._find_root(squares, player)
+        trial_root = TrialBoard(board, detect_reverse(board))
+
+        for dummy_trial in range(trials):
+            trial_board = trial_root.clone()
+            node, to_move = 0, player
+            while self._first_child[node] >= 0 and trial_board.check_win() == None:
+                node = self._select(node)
+                trial_board.move(self._move[node] // dim, self._move[node] % dim, to_move)
+                to_move = provided.switch_player(to_move)
+            # expand a leaf on its second visit, so one-off rollouts add no nodes
+            if (trial_board.check_win() == None and (node == 0 or self._visits[node] > 0)
+                    and len(self._move) < self._max_nodes):
+                empty_squares = trial_board.get_empty_squares()
+                self._first_child[node] = len(self._move)
+                self._num_children[node] = len(empty_squares)
+                for (row, col) in empty_squares:
+                    self._add_node(row * dim + col, node)
+                node = self._select(node)
+                trial_board.move(self._move[node] // dim, self._move[node] % dim, to_move)
+                to_move = provided.switch_player(to_move)
+            trial_board.play_out(to_move, self._random)
+
+            # the player who moved into a node is the one not to move there
+            winner = trial_board.check_win()
+            mover = provided.switch_player(to_move)
+            while node >= 0:
+                self._visits[node] += 1
+                if winner == provided.DRAW:
+                    self._wins[node] += 0.5
+                elif winner == mover:
+                    self._wins[node] += 1.0
+                mover = provided.switch_player(mover)
+                node = self._parent[node]
+        self._total_iterations += trials
+
+        self._root_squares = squares
+        self._root_player = player
+        first = self._first_child[0]
+        if first < 0:
+            scores = [[0 for dummy_col in range(dim)] for dummy_row in range(dim)]
+            return get_best_move(board, scores, self._random)
+        best = max(range(first, first + self._num_children[0]),
+                   key=lambda child: self._visits[child])
+        return divmod(self._move[best], dim)
+
+    def get_stats(self):
+        """
+        Search statistics: tree size, root visits, total iterations and
+        visits inherited from earlier turns
+        Returns a dictionary
+        """
+        return {"nodes": len(self._move),
+                "root_visits": self._visits[0],
+                "iterations": self._total_iterations,
+                "reused_visits": self._reused_visits}
+
+
 # Test game with the console or the GUI.  Uncomment whichever 
 # you prefer.  Both should be commented out when you submit 
 # for testing to save time.
 
 # provided.play_game(mc_move, NTRIALS, False)        
+# provided.play_game(mc_vector_move, NTRIALS, False)
+# provided.play_game(UCTPlayer().choose_move, NTRIALS, False)
+# provided.play_game(ParallelMonteCarloPlayer().choose_move, NTRIALS, False)
+# provided.play_game(CachedMonteCarloPlayer().choose_move, NTRIALS, False)
+# test_vector_scores()
+# benchmark_trials()
 #poc_ttt_gui.run_gui(3, provided.PLAYERX, mc_move, NTRIALS, False)